@@ -0,0 +1,244 @@
+###IMPORTS###
+import queue
+import threading
+import time
+from instrumentation import metrics
+
+class PipelineStage(threading.Thread):
+    '''
+    A worker thread that takes items from its input queue, processes them and pushes the results
+    to its output queue. The queues are bounded so a slow stage applies backpressure on the previous ones.
+    process(item) returns an iterable of results, so one input can produce several outputs
+    (e.g. one prompt -> several sentences).
+    on_error(item) is called when processing an item fails, e.g. to release the turn it belonged to.
+    '''
+    def __init__(self, name, process, input_queue=None, output_queue=None, stop_event=None, on_error=None):
+        super().__init__(name=name, daemon=True)
+        self.process = process
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.stop_event = stop_event or threading.Event()
+        self.on_error = on_error
+        self.busy = False
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.last_seconds = 0.0
+        self.last_wait_seconds = 0.0
+        self.errors = 0
+
+    def get(self):
+        """Waits for the next input item. Returns None when the pipeline is stopped."""
+        wait_start_time = time.time()
+        while not self.stop_event.is_set():
+            try:
+                item = self.input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.last_wait_seconds = time.time() - wait_start_time
+            self.wait_seconds += self.last_wait_seconds
+            return item
+        return None
+
+    def put(self, item):
+        """Pushes an item to the next stage, blocking while its queue is full."""
+        wait_start_time = time.time()
+        while not self.stop_event.is_set():
+            try:
+                self.output_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.wait_seconds += time.time() - wait_start_time
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if self.input_queue is None:
+                item = None
+            else:
+                item = self.get()
+                if item is None:
+                    break
+            self.busy = True
+            start_time = time.time()
+            blocked_seconds, outputs = 0.0, 0
+            try:
+                for result in self.process(item):
+                    if self.output_queue is not None and result is not None:
+                        # Time spent blocked on the next stage is counted as wait, not work
+                        busy_until = time.time()
+                        self.put(result)
+                        blocked_seconds += time.time() - busy_until
+                        outputs += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"[Pipeline] \033[91m{self.name} failed: {e}\033[0m")
+                if self.on_error is not None:
+                    self.on_error(item)
+            self.last_seconds = time.time() - start_time - blocked_seconds
+            metrics.record(f"pipeline.{self.name}", self.last_seconds, outputs=outputs,
+                           queue_wait_seconds=self.last_wait_seconds if self.input_queue is not None else 0.0,
+                           blocked_seconds=blocked_seconds,
+                           queue_depth=self.input_queue.qsize() if self.input_queue is not None else 0)
+            self.busy_seconds += self.last_seconds
+            self.processed += 1
+            self.busy = False
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.input_queue.qsize() if self.input_queue is not None else 0,
+            "busy": self.busy,
+            "processed": self.processed,
+            "errors": self.errors,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "wait_seconds": round(self.wait_seconds, 3),
+            "last_seconds": round(self.last_seconds, 3),
+            "avg_seconds": round(self.busy_seconds / self.processed, 3) if self.processed else 0.0,
+        }
+
+class AssistantPipeline:
+    '''
+    Runs capture -> STT -> LLM sentence stream -> TTS synthesis -> playback as concurrent stages
+    connected by bounded queues. Synthesis of sentence N+1 overlaps with playback of sentence N and,
+    with listen_while_speaking, capture of the next utterance overlaps with playback.
+    '''
+    def __init__(self, assistant, user_name="Jun", queue_size=4, listen_while_speaking=False, incremental_stt=False):
+        self.assistant = assistant
+        self.user_name = user_name
+        self.listen_while_speaking = listen_while_speaking
+        self.stop_event = threading.Event()
+        # Set while playback is idle, used to avoid capturing our own voice
+        self.playback_idle = threading.Event()
+        self.playback_idle.set()
+        # Turns and sentences in flight (captured but not fully answered / generated but not played yet)
+        self.pending_items = 0
+        self.lock = threading.Lock()
+
+        audio_queue = queue.Queue(maxsize=queue_size)
+        text_queue = queue.Queue(maxsize=queue_size)
+        sentence_queue = queue.Queue(maxsize=queue_size)
+        wav_queue = queue.Queue(maxsize=queue_size)
+
+        stages = []
+        if assistant.has_stt and incremental_stt:
+            # Transcription runs while capturing, the stage outputs text directly
+            stages.append(PipelineStage("capture_stt", self.capture_and_transcribe, None, text_queue, self.stop_event))
+        elif assistant.has_stt:
+            stages.append(PipelineStage("capture", self.capture, None, audio_queue, self.stop_event))
+            stages.append(PipelineStage("stt", self.transcribe, audio_queue, text_queue, self.stop_event, self.release_item))
+        else:
+            stages.append(PipelineStage("input", self.read_input, None, text_queue, self.stop_event))
+        # generate() releases its turn itself, even when it fails
+        stages.append(PipelineStage("llm", self.generate, text_queue, sentence_queue, self.stop_event))
+        if assistant.has_tts:
+            stages.append(PipelineStage("tts", self.synthesize, sentence_queue, wav_queue, self.stop_event, self.release_item))
+            stages.append(PipelineStage("playback", self.play, wav_queue, None, self.stop_event, self.release_item))
+        else:
+            stages.append(PipelineStage("print", self.print_sentence, sentence_queue, None, self.stop_event, self.release_item))
+        self.stages = {stage.name: stage for stage in stages}
+
+    ### STAGES ###
+    def capture(self, _):
+        if not self.listen_while_speaking:
+            while not self.playback_idle.wait(timeout=0.1):
+                if self.stop_event.is_set():
+                    return
+        audio = self.assistant.audio_capture.capture()
+        if len(audio):
+            self.start_turn()
+            yield audio
+
+    def capture_and_transcribe(self, _):
+        if not self.listen_while_speaking:
+            while not self.playback_idle.wait(timeout=0.1):
+                if self.stop_event.is_set():
+                    return
+        text = self.assistant.listen_and_transcribe_incremental()
+        if text.strip():
+            self.start_turn()
+            yield text
+
+    def read_input(self, _):
+        if not self.listen_while_speaking:
+            self.playback_idle.wait()
+        prompt = input("> ")
+        self.start_turn()
+        yield prompt
+
+    def transcribe(self, audio):
+        text = self.assistant.stt_module.generate_text_from_audio(audio=audio)
+        if text.strip():
+            yield text
+        else:
+            self.update_idle(done_items=1)
+
+    def generate(self, prompt):
+        try:
+            with metrics.profile_turn("pipeline_turn"):
+                for sentence in self.assistant.generator.stream_sentences(prompt=prompt, user_name=self.user_name):
+                    with self.lock:
+                        self.pending_items += 1
+                    yield sentence
+        finally:
+            # The turn itself is done, its sentences are tracked separately
+            self.update_idle(done_items=1)
+
+    def synthesize(self, sentence):
+        yield self.assistant.tts_module.synthesize(sentence)
+
+    def play(self, wav):
+        self.assistant.tts_module.play_wav(wav)
+        self.update_idle(done_items=1)
+        return ()
+
+    def print_sentence(self, sentence):
+        print(sentence)
+        self.update_idle(done_items=1)
+        return ()
+
+    def start_turn(self):
+        with self.lock:
+            self.pending_items += 1
+            self.playback_idle.clear()
+
+    def release_item(self, _):
+        """Called when a stage fails on an item, its turn or sentence will never reach playback."""
+        self.update_idle(done_items=1)
+
+    def update_idle(self, done_items=0):
+        """Marks playback as idle once the reply is fully generated and every sentence was played."""
+        with self.lock:
+            self.pending_items -= done_items
+            if self.pending_items <= 0:
+                self.pending_items = 0
+                self.playback_idle.set()
+
+    ### CONTROL ###
+    def start(self):
+        for stage in self.stages.values():
+            stage.start()
+
+    def stop(self, timeout=2.0):
+        self.stop_event.set()
+        self.playback_idle.set()
+        for stage in self.stages.values():
+            stage.join(timeout=timeout)
+
+    def is_busy(self) -> bool:
+        return any(stage.busy for name, stage in self.stages.items() if name not in ("capture", "capture_stt", "input"))
+
+    def stats(self) -> dict:
+        """Per-stage queue depth and timings."""
+        return {name: stage.stats() for name, stage in self.stages.items()}
+
+    def run_forever(self, report_every=0):
+        self.start()
+        try:
+            while not self.stop_event.is_set():
+                time.sleep(report_every or 0.5)
+                if report_every:
+                    print(f"[Pipeline] {self.stats()}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
@@ -0,0 +1,225 @@
+"""
+End-to-end latency benchmark of the voice assistant.
+Drives a headless VoiceAssistant (no microphone, no speakers) with the turns of a fixture file:
+a turn is a WAV file fed as if it had just been captured, or a text prompt when its WAV is missing.
+The reply is streamed sentence by sentence into XTTS like in a real turn, and the speech is discarded.
+
+Every metric is measured per turn and reported as p50/p95 over all the turns:
+- capture_to_transcript: end of the captured utterance -> transcript (PCM conversion, resampling, Whisper),
+- prefill_seconds / prefill_tokens: forward pass over the part of the prompt not in the KV cache,
+- time_to_first_token / tokens_per_second: LLM generation,
+- time_to_first_audio: end of the utterance -> first synthesized audio chunk of the reply,
+- tts_real_time_factor: synthesis time / duration of the synthesized audio,
+- turn_latency: end of the utterance -> whole reply synthesized.
+
+Usage:
+    python benchmark.py --json bench.json
+    python benchmark.py --tiny --repeat 3 --json bench_tiny.json --baseline bench_tiny_previous.json
+    python benchmark.py --record-fixtures    # synthesize the missing fixture WAVs from their prompts
+
+The fixture WAVs are committed next to turns.json, so every run (--tiny included) transcribes the same audio.
+The ones shipped were recorded with espeak-ng (see "recorded_with" in turns.json), mono 16-bit at 22050 Hz with
+300 ms of silence on each side like a VAD capture. --record-fixtures only synthesizes the WAVs of new turns,
+with XTTS in deterministic mode and the voice, language and seed of turns.json. Results are only comparable
+between runs on the same fixture files, the commit of the fixtures is part of the baseline.
+Turns whose WAV is missing are sent to the LLM as text and have no capture_to_transcript.
+"""
+###IMPORTS###
+import argparse
+import json
+import platform
+import subprocess
+import time
+from pathlib import Path
+import numpy as np
+from stt_gen.audio_utils import read_wav, float32_to_pcm16, to_model_input, write_wav
+from main import VoiceAssistant
+
+THIS_DIR = Path(__file__).parent.resolve()
+DEFAULT_FIXTURES = THIS_DIR / "benchmark_fixtures" / "turns.json"
+CONTEXT = "Your name is Rose. You provide one sentence responses. My name is located before the colon or ':'."
+# Small models for quick runs, XTTS has no small variant so TTS is skipped unless --tts is given
+TINY_MODELS = {"stt": "openai/whisper-tiny", "gen": "Qwen/Qwen2.5-0.5B-Instruct", "max_new_tokens": 32}
+METRICS = ["capture_to_transcript", "prefill_seconds", "prefill_tokens", "time_to_first_token", "tokens_per_second",
+           "time_to_first_audio", "tts_real_time_factor", "turn_latency"]
+
+def load_fixtures(filepath):
+    filepath = Path(filepath)
+    with open(filepath, "r") as fixtures_file:
+        fixtures = json.load(fixtures_file)
+    for turn in fixtures["turns"]:
+        if "audio" in turn:
+            turn["audio"] = (filepath.parent / turn["audio"]).resolve()
+    return fixtures
+
+def record_fixtures(assistant, fixtures):
+    """Synthesizes the prompt of every turn whose WAV file is missing, seeded so the recording is reproducible."""
+    tts = assistant.tts_module
+    # Reseeded before every synthesis, each WAV does not depend on the others
+    tts.params["deterministic"] = True
+    tts.params["seed"] = int(fixtures.get("seed", 1234))
+    for turn in fixtures["turns"]:
+        if "audio" in turn and "prompt" in turn and not turn["audio"].exists():
+            wav = tts.synthesize(turn["prompt"], voice=fixtures.get("voice"), language=fixtures.get("language"), use_cache=False)
+            write_wav(turn["audio"], wav, tts.sample_rate)
+            print(f"[BENCHMARK] Recorded {turn['audio'].name}")
+
+def capture_pcm(turn) -> tuple:
+    """Returns the fixture as (int16 PCM bytes, rate), like the frames of a capture, or (None, None)."""
+    if "audio" not in turn or not turn["audio"].exists():
+        return None, None
+    audio, rate = read_wav(turn["audio"])
+    return float32_to_pcm16(audio).tobytes(), rate
+
+def run_turn(assistant, turn, user_name) -> dict:
+    result = {"turn": turn.get("prompt") or turn["audio"].name}
+    pcm, rate = capture_pcm(turn) if assistant.has_stt else (None, None)
+    # The clock starts when the user stops speaking
+    turn_start_time = time.time()
+    prompt = turn.get("prompt", "")
+    if pcm is not None:
+        audio = to_model_input(pcm, rate, assistant.stt_module.sampling_rate)
+        prompt = assistant.listen_and_transcribe(audio=audio)
+        result["capture_to_transcript"] = time.time() - turn_start_time
+        result["transcript"] = prompt
+
+    sentences = [prompt]
+    if assistant.has_gen:
+        sentences = assistant.generator.stream_sentences(prompt=prompt, user_name=user_name, save_to_history=False)
+    reply, generate_seconds, audio_seconds = [], 0.0, 0.0
+    for sentence in sentences:
+        reply.append(sentence)
+        if not assistant.has_tts:
+            continue
+        tts = assistant.tts_module
+        sentence_start_time = time.time()
+        tts.stream_audio(sentence)
+        if "time_to_first_audio" not in result:
+            result["time_to_first_audio"] = sentence_start_time - turn_start_time + tts.last_first_chunk_seconds
+        generate_seconds += tts.last_generate_seconds
+        audio_seconds += tts.last_audio_seconds
+    result["turn_latency"] = time.time() - turn_start_time
+    result["reply"] = " ".join(reply)
+
+    if assistant.has_gen:
+        generator = assistant.generator
+        result["prefill_seconds"] = generator.last_prefill_seconds
+        result["prefill_tokens"] = generator.last_prefill_tokens
+        result["time_to_first_token"] = generator.last_first_token_seconds
+        if generator.last_generate_seconds:
+            result["tokens_per_second"] = generator.last_generated_tokens / generator.last_generate_seconds
+    if audio_seconds:
+        result["tts_real_time_factor"] = generate_seconds / audio_seconds
+    return result
+
+def summarize(turns:list) -> dict:
+    summary = {}
+    for metric in METRICS:
+        values = [turn[metric] for turn in turns if turn.get(metric) is not None]
+        if not values:
+            continue
+        summary[metric] = {
+            "p50": round(float(np.percentile(values, 50)), 4),
+            "p95": round(float(np.percentile(values, 95)), 4),
+            "mean": round(float(np.mean(values)), 4),
+            "n": len(values),
+        }
+    return summary
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=THIS_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def print_summary(summary:dict, baseline:dict=None):
+    print(f"\n{'metric':<24}{'p50':>10}{'p95':>10}{'n':>6}" + (f"{'p50 vs baseline':>18}" if baseline else ""))
+    for metric, values in summary.items():
+        line = f"{metric:<24}{values['p50']:>10.3f}{values['p95']:>10.3f}{values['n']:>6}"
+        previous = (baseline or {}).get(metric)
+        if previous and previous["p50"]:
+            line += f"{(values['p50'] - previous['p50']) / previous['p50'] * 100:>+17.1f}%"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless end-to-end latency benchmark.")
+    parser.add_argument("--fixtures", default=str(DEFAULT_FIXTURES), help="JSON file listing the turns.")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of the whole fixture conversation.")
+    parser.add_argument("--warmup", type=int, default=1, help="Turns run before measuring.")
+    parser.add_argument("--tiny", action="store_true", help="Use small models and short replies for quick runs.")
+    parser.add_argument("--tts", action=argparse.BooleanOptionalAction, default=None, help="Synthesize the replies (off with --tiny).")
+    parser.add_argument("--stt-model", default="")
+    parser.add_argument("--gen-model", default="")
+    parser.add_argument("--max-new-tokens", type=int, default=0)
+    parser.add_argument("--cpu-profile", default="", help="Named profile from cpu_profiles.json.")
+    parser.add_argument("--audio-cache", action="store_true", help="Keep the TTS audio cache (disabled by default).")
+    parser.add_argument("--tts-process", action="store_true", help="Run XTTS in a separate worker process.")
+    parser.add_argument("--record-fixtures", action="store_true", help="Synthesize the missing fixture WAVs and exit.")
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    stt_model = args.stt_model or (TINY_MODELS["stt"] if args.tiny else "")
+    gen_model = args.gen_model or (TINY_MODELS["gen"] if args.tiny else "")
+    max_new_tokens = args.max_new_tokens or (TINY_MODELS["max_new_tokens"] if args.tiny else 0)
+    has_tts = args.tts if args.tts is not None else not args.tiny
+    fixtures = load_fixtures(args.fixtures)
+    user_name = fixtures.get("user_name", "Jun")
+
+    if args.record_fixtures:
+        assistant = VoiceAssistant(input_device="", context=CONTEXT, has_stt=False, has_gen=False, has_tts=True, headless=True)
+        record_fixtures(assistant, fixtures)
+        return
+
+    load_start_time = time.time()
+    assistant = VoiceAssistant(input_device="", context=CONTEXT, has_tts=has_tts, cpu_profile=args.cpu_profile,
+                               headless=True, stt_model=stt_model, gen_model=gen_model, tts_process=args.tts_process)
+    # The benchmark measures every model, not only the ones needed to start
+    assistant.loader.wait_all()
+    load_seconds = time.time() - load_start_time
+    if max_new_tokens:
+        assistant.generator.max_new_tokens = max_new_tokens
+    if has_tts and not args.audio_cache:
+        # Repeated turns would otherwise only measure cache hits
+        assistant.tts_module.disable_audio_cache()
+
+    for turn in fixtures["turns"][:args.warmup]:
+        run_turn(assistant, turn, user_name)
+    turns = []
+    for run in range(args.repeat):
+        # Every run replays the same conversation from the start
+        assistant.generator.reset_conversation()
+        for turn in fixtures["turns"]:
+            result = run_turn(assistant, turn, user_name)
+            result["run"] = run
+            turns.append(result)
+            print(f"[BENCHMARK] {result['turn']}: \033[93m{result['turn_latency']:.2f} seconds\033[0m")
+
+    summary = summarize(turns)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)["summary"]
+    print_summary(summary, baseline)
+    if args.json:
+        results = {
+            "meta": {
+                "commit": git_commit(),
+                "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "models": {"stt": stt_model or "default", "gen": gen_model or "default", "tts": "xtts" if has_tts else None},
+                "max_new_tokens": max_new_tokens or None,
+                "cpu_profile": args.cpu_profile or None,
+                "tts_process": args.tts_process,
+                "repeat": args.repeat,
+                "load_seconds": round(load_seconds, 2),
+            },
+            "summary": summary,
+            "turns": turns,
+        }
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=4, default=str)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+###IMPORTS###
+import json
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+class ModelProfile:
+    '''
+    CPU settings for one model: dynamic int8 quantization of the Linear layers, torch thread counts
+    and optional torch.compile / BetterTransformer. Only applied when the model runs on CPU.
+    The intra-op thread count is process wide: a model's budget only holds while it runs alone.
+    When the inferences of several models overlap, the most recently entered scope sets the count for all of them.
+    '''
+    # torch.set_num_threads is process wide, the scopes in progress are tracked together
+    threads_lock = threading.Lock()
+    active_threads = []
+    base_threads = None
+
+    def __init__(self, quantize=False, threads=None, interop_threads=None, compile=False, better_transformer=False):
+        self.quantize = quantize
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.compile = compile
+        self.better_transformer = better_transformer
+
+    def to_dict(self) -> dict:
+        return {"quantize": self.quantize, "threads": self.threads, "interop_threads": self.interop_threads,
+                "compile": self.compile, "better_transformer": self.better_transformer}
+
+    def apply(self, model, device="cpu"):
+        """Returns the optimized model. Layers are swapped in place, so keep using the returned object."""
+        if str(device) != "cpu":
+            return model
+        import torch
+        self.set_interop_threads()
+        if self.better_transformer:
+            try:
+                from optimum.bettertransformer import BetterTransformer
+                model = BetterTransformer.transform(model)
+            except Exception as e:
+                print(f"[CPU_PROFILE] \033[91mBetterTransformer not applied: {e}\033[0m")
+        if self.quantize:
+            dtype = next(model.parameters()).dtype
+            if dtype != torch.float32:
+                # The dynamic int8 Linear kernels only take float32 activations
+                print(f"[CPU_PROFILE] Converting the {dtype} model to float32 before quantization.")
+                model = model.float()
+            convert_conv1d_to_linear(model)
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        if self.compile:
+            try:
+                model.forward = torch.compile(model.forward)
+            except Exception as e:
+                print(f"[CPU_PROFILE] \033[91mtorch.compile not applied: {e}\033[0m")
+        return model
+
+    def set_interop_threads(self):
+        if not self.interop_threads:
+            return
+        import torch
+        try:
+            torch.set_num_interop_threads(int(self.interop_threads))
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work started
+            print(f"[CPU_PROFILE] Inter-op threads already set to {torch.get_num_interop_threads()}.")
+
+    @contextmanager
+    def thread_scope(self):
+        """
+        Runs the block with this model's intra-op thread count. Overlapping scopes may exit in any order:
+        the count goes back to the latest scope still running, and to the count from before the first scope
+        once none is left.
+        """
+        if not self.threads:
+            yield
+            return
+        import torch
+        threads = int(self.threads)
+        cls = ModelProfile
+        with cls.threads_lock:
+            if not cls.active_threads:
+                cls.base_threads = torch.get_num_threads()
+            cls.active_threads.append(threads)
+            torch.set_num_threads(threads)
+        try:
+            yield
+        finally:
+            with cls.threads_lock:
+                cls.active_threads.remove(threads)
+                torch.set_num_threads(cls.active_threads[-1] if cls.active_threads else cls.base_threads)
+
+def convert_conv1d_to_linear(module):
+    """
+    GPT-2 style blocks (used by the XTTS GPT) are built with transformers Conv1D, which dynamic quantization
+    does not know. Conv1D is a Linear layer with a transposed weight, so swap it for a real nn.Linear.
+    """
+    import torch
+    try:
+        from transformers.pytorch_utils import Conv1D
+    except ImportError:
+        return module
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1], bias=child.bias is not None)
+            linear.weight.data = child.weight.data.t().contiguous()
+            if child.bias is not None:
+                linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            convert_conv1d_to_linear(child)
+    return module
+
+def load_profile(name="default", filepath="") -> dict:
+    """Returns {"stt": ModelProfile, "gen": ModelProfile, "tts": ModelProfile} for the named profile."""
+    if not filepath:
+        filepath = Path(__file__).parent.resolve() / "cpu_profiles.json"
+    with open(filepath, "r") as profiles_file:
+        profiles = json.load(profiles_file)
+    if name not in profiles:
+        raise KeyError(f"Unknown CPU profile '{name}', available: {', '.join(profiles)}")
+    return {model: ModelProfile(**settings) for model, settings in profiles[name].items()}
@@ -0,0 +1,131 @@
+"""
+Accuracy/latency comparison of the CPU profiles in cpu_profiles.json.
+Each profile loads its own copy of the models, runs the same inputs and is compared with the first profile
+given, which is used as the reference (usually "default"):
+- stt: mean latency and word error rate against the reference transcripts,
+- gen: mean latency, tokens/s and word error rate against the reference replies (greedy decoding),
+- tts: mean latency, real-time factor and duration difference (seeded sampling).
+
+Usage: python cpu_profile_report.py default int8 int8_split_threads --models stt gen tts --json cpu_report.json
+"""
+###IMPORTS###
+import argparse
+import gc
+import json
+import tempfile
+import time
+from pathlib import Path
+from cpu_profile import load_profile
+
+THIS_DIR = Path(__file__).parent.resolve()
+DEFAULT_AUDIO = [str(THIS_DIR / "tts_gen" / "voices" / "female_01.wav"), str(THIS_DIR / "tts_gen" / "voices" / "male_01.wav")]
+DEFAULT_PROMPTS = ["Hello, how are you?", "How much is 2 + 2?", "Give me a short tip to sleep better."]
+DEFAULT_SENTENCES = ["Hello, nice to meet you.", "The weather is lovely today, let's go for a walk."]
+
+def word_error_rate(reference:str, hypothesis:str) -> float:
+    ref, hyp = reference.lower().split(), hypothesis.lower().split()
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    distances = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        previous, distances[0] = distances[0], i
+        for j, hyp_word in enumerate(hyp, 1):
+            previous, distances[j] = distances[j], min(distances[j] + 1, distances[j - 1] + 1, previous + (ref_word != hyp_word))
+    return distances[-1] / len(ref)
+
+def evaluate_stt(profile, audio_paths) -> dict:
+    from stt_gen.stt_main import SpeechToTextGenerator
+    load_start_time = time.time()
+    stt = SpeechToTextGenerator(cpu_profile=profile)
+    load_seconds = time.time() - load_start_time
+    texts, latencies = [], []
+    for audio_path in audio_paths:
+        texts.append(stt.generate_text_from_audio(audio_filepath=audio_path))
+        latencies.append(stt.last_latency)
+    return {"load_seconds": load_seconds, "latency_seconds": sum(latencies) / len(latencies), "outputs": texts}
+
+def evaluate_gen(profile, prompts, max_new_tokens=64) -> dict:
+    from text_gen.hf_text_generator import ResponseGenerator
+    load_start_time = time.time()
+    generator = ResponseGenerator(cpu_profile=profile, history_path=str(Path(tempfile.mkdtemp()) / "history.db"))
+    load_seconds = time.time() - load_start_time
+    texts, latencies, tokens = [], [], 0
+    for prompt in prompts:
+        messages = [generator.messages[0], {"role": "user", "content": f"Jun: {prompt}"}]
+        text = generator.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        model_inputs = generator.tokenizer([text], return_tensors="pt").to(generator.device)
+        generate_start_time = time.time()
+        with profile.thread_scope():
+            # Greedy decoding so the profiles can be compared token for token
+            generated_ids = generator.model.generate(**model_inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        latencies.append(time.time() - generate_start_time)
+        generated_ids = generated_ids[0, model_inputs.input_ids.shape[1]:]
+        tokens += len(generated_ids)
+        texts.append(generator.tokenizer.decode(generated_ids, skip_special_tokens=True))
+    generator.history.close()
+    return {"load_seconds": load_seconds, "latency_seconds": sum(latencies) / len(latencies),
+            "tokens_per_second": tokens / sum(latencies), "outputs": texts}
+
+def evaluate_tts(profile, sentences) -> dict:
+    from tts_gen.tts_main import TextToSpeechGenerator
+    from tts_gen.audio_sink import NullSink
+    load_start_time = time.time()
+    tts = TextToSpeechGenerator(sink=NullSink(), cpu_profile=profile)
+    load_seconds = time.time() - load_start_time
+    # Measure synthesis, not the cache, and make the sampling repeatable
+    tts.disable_audio_cache()
+    tts.params["deterministic"] = True
+    durations, latencies = [], []
+    for sentence in sentences:
+        generate_start_time = time.time()
+        wav = tts.synthesize(sentence)
+        latencies.append(time.time() - generate_start_time)
+        durations.append(len(wav) / tts.sample_rate)
+    return {"load_seconds": load_seconds, "latency_seconds": sum(latencies) / len(latencies),
+            "real_time_factor": sum(latencies) / max(sum(durations), 1e-6), "outputs": durations}
+
+def compare(results:dict, reference_name:str) -> dict:
+    """Adds the accuracy of every profile relative to the reference profile."""
+    for model, per_profile in results.items():
+        reference = per_profile[reference_name]["outputs"]
+        for result in per_profile.values():
+            outputs = result["outputs"]
+            if model in ("stt", "gen"):
+                result["word_error_rate"] = sum(word_error_rate(r, o) for r, o in zip(reference, outputs)) / len(outputs)
+            else:
+                result["duration_difference"] = sum(abs(o - r) / max(r, 1e-6) for r, o in zip(reference, outputs)) / len(outputs)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CPU profiles for latency and accuracy.")
+    parser.add_argument("profiles", nargs="+", help="Profile names, the first one is the reference.")
+    parser.add_argument("--models", nargs="+", default=["stt", "gen", "tts"], choices=["stt", "gen", "tts"])
+    parser.add_argument("--audio", nargs="+", default=DEFAULT_AUDIO)
+    parser.add_argument("--json", help="Write the report to this JSON file.")
+    args = parser.parse_args()
+
+    evaluators = {"stt": lambda profile: evaluate_stt(profile, args.audio),
+                  "gen": lambda profile: evaluate_gen(profile, DEFAULT_PROMPTS),
+                  "tts": lambda profile: evaluate_tts(profile, DEFAULT_SENTENCES)}
+    results = {model: {} for model in args.models}
+    for name in args.profiles:
+        profiles = load_profile(name)
+        for model in args.models:
+            print(f"\033[94m[CPU_REPORT] {name} / {model}\033[0m")
+            results[model][name] = evaluators[model](profiles[model])
+            results[model][name]["settings"] = profiles[model].to_dict()
+            # Free the models before loading the next profile
+            gc.collect()
+    compare(results, args.profiles[0])
+
+    for model, per_profile in results.items():
+        print(f"\n{model}:")
+        for name, result in per_profile.items():
+            metrics = {key: round(value, 3) for key, value in result.items() if isinstance(value, float)}
+            print(f"  {name:<24} {metrics}")
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump(results, report_file, indent=4)
+
+if __name__ == "__main__":
+    main()
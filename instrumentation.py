@@ -0,0 +1,292 @@
+###IMPORTS###
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Windows, the peak RSS is then taken from psutil when available
+    resource = None
+
+# Histogram upper bounds for durations (seconds), ratios (*_rate, *_factor) and counts (tokens, samples...)
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.25, 1.5, 2.0, 3.0, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 100000, 1000000)
+
+def buckets_for(metric):
+    if metric.endswith("seconds"):
+        return SECONDS_BUCKETS
+    if metric.endswith(("_rate", "_factor", "_ratio")):
+        return RATIO_BUCKETS
+    return COUNT_BUCKETS
+
+def memory_high_water() -> dict:
+    """Peak resident memory of the process and, when CUDA is used, peak allocated GPU memory, in bytes."""
+    memory = {}
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        memory["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+    elif "psutil" in sys.modules:
+        memory["peak_rss_bytes"] = getattr(sys.modules["psutil"].Process().memory_info(), "peak_wset", 0)
+    # Only look at CUDA if torch was already imported by a model
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        memory["cuda_peak_bytes"] = torch.cuda.max_memory_allocated()
+    return memory
+
+class Histogram:
+    '''
+    Cumulative histogram with fixed bucket upper bounds, in the Prometheus format.
+    '''
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q) -> float:
+        """Upper bound of the bucket holding the q-quantile, the max for the last bucket."""
+        if not self.count:
+            return 0.0
+        target, cumulative = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "max": round(self.max, 6),
+        }
+
+class Span:
+    '''
+    Times a block of work. Attributes added with set() are exported with the span,
+    and the numeric ones are also observed in per-span histograms.
+    '''
+    __slots__ = ("instrumentation", "name", "attributes", "start_time", "wall_time", "seconds")
+
+    def __init__(self, instrumentation, name, attributes):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.attributes = attributes
+        self.seconds = 0.0
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.wall_time = time.time()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.seconds = time.perf_counter() - self.start_time
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.instrumentation.finish(self)
+        return False
+
+class NullSpan:
+    '''Returned when instrumentation is disabled, does nothing.'''
+    __slots__ = ()
+    seconds = 0.0
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Instrumentation:
+    '''
+    In-process metrics of the assistant stages.
+    Stages wrap their work in span(name) blocks; every finished span is observed in histograms
+    (duration and numeric attributes such as tokens, samples or queue waits, per span name), optionally appended
+    to a JSONL file and printed. The histograms can be exported in the Prometheus text format.
+    With profile_every=N, every N-th turn wrapped in profile_turn() is recorded with the torch profiler
+    and saved as a Chrome trace in profile_dir.
+    When disabled, span() returns a shared no-op object.
+    '''
+    def __init__(self, enabled=True, jsonl_path="", log=False, profile_every=0, profile_dir=""):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.peak_memory = {}
+        self.turns = 0
+        self.profiling = False
+        self.jsonl_file = None
+        self.configure(enabled=enabled, jsonl_path=jsonl_path, log=log, profile_every=profile_every, profile_dir=profile_dir)
+
+    def configure(self, enabled=None, jsonl_path=None, log=None, profile_every=None, profile_dir=None):
+        """Changes the settings given, the others are kept."""
+        with self.lock:
+            if enabled is not None:
+                self.enabled = enabled
+            if log is not None:
+                self.log = log
+            if profile_every is not None:
+                self.profile_every = profile_every
+            if profile_dir is not None:
+                self.profile_dir = profile_dir or str(Path(__file__).parent.resolve() / "profiles")
+            if jsonl_path is not None:
+                if self.jsonl_file is not None:
+                    self.jsonl_file.close()
+                self.jsonl_file = open(jsonl_path, "a", buffering=1) if jsonl_path else None
+
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    def record(self, name, seconds, **attributes):
+        """Records a span whose duration was measured elsewhere (time to first token, queue wait...)."""
+        if not self.enabled:
+            return
+        span = Span(self, name, attributes)
+        span.wall_time = time.time() - seconds
+        span.seconds = seconds
+        self.finish(span)
+
+    def observe(self, metric, span_name, value):
+        key = (metric, span_name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets_for(metric))
+        histogram.observe(value)
+
+    def finish(self, span):
+        memory = memory_high_water()
+        with self.lock:
+            self.observe("seconds", span.name, span.seconds)
+            for key, value in span.attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.observe(key, span.name, value)
+            for key, value in memory.items():
+                self.peak_memory[key] = max(self.peak_memory.get(key, 0), value)
+            if self.jsonl_file is not None:
+                record = {"time": round(span.wall_time, 3), "span": span.name, "seconds": round(span.seconds, 6),
+                          "thread": threading.current_thread().name, **span.attributes, **memory}
+                self.jsonl_file.write(json.dumps(record, default=str) + "\n")
+        if self.log:
+            attributes = " ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                                  for key, value in span.attributes.items())
+            print(f"[{span.name}] {span.seconds:.3f}s {attributes}")
+
+    @contextmanager
+    def profile_turn(self, name="turn"):
+        """Runs the block under the torch profiler for one turn out of profile_every."""
+        with self.lock:
+            self.turns += 1
+            sampled = self.enabled and self.profile_every and self.turns % self.profile_every == 0 and not self.profiling
+            if sampled:
+                self.profiling = True
+            turn = self.turns
+        if not sampled:
+            yield
+            return
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        try:
+            with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as profiler:
+                yield
+            Path(self.profile_dir).mkdir(parents=True, exist_ok=True)
+            trace_path = Path(self.profile_dir) / f"{name}_{turn}_{int(time.time())}.json"
+            profiler.export_chrome_trace(str(trace_path))
+            print(f"[Instrumentation] Torch profiler trace written to {trace_path}")
+        finally:
+            self.profiling = False
+
+    ### EXPORT ###
+    def snapshot(self) -> dict:
+        """{span name: {metric: histogram summary}} plus the memory high-water marks."""
+        with self.lock:
+            spans = {}
+            for (metric, span_name), histogram in sorted(self.histograms.items(), key=lambda item: (item[0][1], item[0][0])):
+                spans.setdefault(span_name, {})[metric] = histogram.summary()
+            return {"spans": spans, "memory": dict(self.peak_memory)}
+
+    def to_prometheus(self, prefix="voice_assistant") -> str:
+        lines = []
+        with self.lock:
+            metrics = sorted({metric for metric, _ in self.histograms})
+            for metric in metrics:
+                name = f"{prefix}_{metric}"
+                lines.append(f"# TYPE {name} histogram")
+                for (key, span_name), histogram in sorted(self.histograms.items()):
+                    if key != metric:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{span="{span_name}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{span="{span_name}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{span="{span_name}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{span="{span_name}"}} {histogram.count}')
+            for key, value in sorted(self.peak_memory.items()):
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filepath):
+        with open(filepath, "w") as metrics_file:
+            metrics_file.write(self.to_prometheus())
+
+    def write_jsonl(self, filepath):
+        """Appends the current snapshot as one JSON line."""
+        with open(filepath, "a") as metrics_file:
+            metrics_file.write(json.dumps({"time": round(time.time(), 3), **self.snapshot()}) + "\n")
+
+    def serve_prometheus(self, port=9100, host="127.0.0.1"):
+        """Serves the Prometheus text on http://host:port/metrics from a daemon thread, only locally by default."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        instrumentation = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = instrumentation.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.peak_memory = {}
+
+# Shared by every module of the assistant
+metrics = Instrumentation()
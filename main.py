@@ -1,46 +1,155 @@
 ###IMPORTS###
-from stt_gen import stt_main, audio_capture_vc
-from text_gen.hf_text_generator import ResponseGenerator
-from tts_gen import tts_main
+import time
+# The model modules import torch/transformers/TTS, they are only imported by the loader
+from stt_gen import audio_capture_vc
+from model_loader import ModelLoader
+from cpu_profile import load_profile
+from instrumentation import metrics
+from model_residency import ResidencyManager
 
 class VoiceAssistant:
     '''
     The main body of the voice assistant. 
     The base class contains a STT module, a text generator and a TTS module.
+    The models are loaded concurrently in the background; with lazy=True each one is only loaded on first use.
+    With headless=True no audio device is opened: audio is passed as buffers and the speech is discarded.
+    instrumentation is passed to metrics.configure(), e.g. {"jsonl_path": "spans.jsonl", "profile_every": 50}.
+    residency sets the memory budget and idle TTL of the models, e.g. {"budget_mb": 6000, "idle_ttl": {"stt": 600}}:
+    idle models are offloaded and loaded again on their next use.
+    With tts_process=True, XTTS runs in a separate process (tts_gen.tts_worker) with its own thread budget.
     '''
-    def __init__(self, input_device:str, context:str, has_stt=True, has_gen=True, has_tts=True):
+    def __init__(self, input_device:str, context:str, has_stt=True, has_gen=True, has_tts=True, lazy=False, wait_for_models=True,
+                 cpu_profile="", headless=False, stt_model="", gen_model="", instrumentation=None,
+                 residency=None, tts_process=False):
         self.has_stt = has_stt
         self.has_tts = has_tts
         self.has_gen = has_gen
         self.is_generating = False
         self.emotion = "neutral"
+        self.headless = headless
+        # Model ids overriding the defaults, e.g. smaller models for benchmarks
+        self.stt_model = stt_model
+        self.gen_model = gen_model
+        self.tts_process = tts_process
+        if instrumentation:
+            metrics.configure(**instrumentation)
         print(f"Starting Voice Assistant with configs - has_stt:{has_stt}, has_gen:{has_gen}, has_tts:{has_tts}")
         
+        # Named CPU performance profile from cpu_profiles.json, none by default
+        self.cpu_profiles = load_profile(cpu_profile) if cpu_profile else {}
+        residency = residency or {}
+        self.residency = ResidencyManager(budget_bytes=int(residency.get("budget_mb", 0)) * 2**20,
+                                          idle_ttl=residency.get("idle_ttl", 0))
+        self.loader = ModelLoader(lazy=lazy)
+        self.audio_capture = None
         if has_stt:
-            self.audio_capture = audio_capture_vc.AudioCapture(input_device)
-            self.stt_module = stt_main.SpeechToTextGenerator()
+            if not headless:
+                self.audio_capture = audio_capture_vc.AudioCapture(input_device)
+            self.loader.register("stt", self.load_stt)
 
         if has_tts:
-            self.tts_module = tts_main.TextToSpeechGenerator()
+            self.loader.register("tts", self.load_tts)
 
         if self.has_gen:
-            self.generator = ResponseGenerator(context=context)
+            self.loader.register("gen", lambda: self.load_generator(context))
 
-    def listen_and_transcribe(self, audiopath="") -> str:
+        self.loader.start()
+        if wait_for_models and not lazy:
+            # Whisper is only needed once the user speaks, don't block on it
+            for name in ("gen", "tts"):
+                if name in self.loader.factories:
+                    self.loader.get(name)
+            print(f"[Voice_Assistant] Models: {self.loader.status()}")
+
+    ### MODEL LOADING ###
+    def load_stt(self):
+        from stt_gen import stt_main
+        kwargs = {"model_id": self.stt_model} if self.stt_model else {}
+        stt_module = stt_main.SpeechToTextGenerator(cpu_profile=self.cpu_profiles.get("stt"), **kwargs)
+        if self.audio_capture is not None:
+            # Resample the captured audio straight to the rate expected by Whisper
+            self.audio_capture.target_rate = stt_module.sampling_rate
+        self.residency.register("stt", stt_module)
+        return stt_module
+
+    def load_tts(self):
+        sink = None
+        if self.headless:
+            from tts_gen.audio_sink import NullSink
+            sink = NullSink()
+        if self.tts_process:
+            # The worker process manages its own memory, it is not registered with the residency manager
+            from tts_gen.tts_worker import TTSWorker
+            return TTSWorker(sink=sink, cpu_profile=self.cpu_profiles.get("tts"))
+        from tts_gen import tts_main
+        tts_module = tts_main.TextToSpeechGenerator(sink=sink, cpu_profile=self.cpu_profiles.get("tts"))
+        # low_vram on CPU comes with its own idle TTL
+        self.residency.register("tts", tts_module, idle_ttl=tts_module.idle_ttl or None)
+        return tts_module
+
+    def load_generator(self, context):
+        from text_gen.hf_text_generator import ResponseGenerator
+        kwargs = {"model_name": self.gen_model} if self.gen_model else {}
+        generator = ResponseGenerator(context=context, cpu_profile=self.cpu_profiles.get("gen"), **kwargs)
+        self.residency.register("gen", generator)
+        return generator
+
+    @property
+    def stt_module(self):
+        return self.loader.get("stt")
+
+    @property
+    def tts_module(self):
+        return self.loader.get("tts")
+
+    @property
+    def generator(self):
+        return self.loader.get("gen")
+
+    def memory_usage(self) -> dict:
+        """Residency and footprint of each model, total resident weights and process RSS, in bytes."""
+        return self.residency.usage()
+
+    def stt_ready(self) -> bool:
+        """True once Whisper can be used. In lazy mode it is loaded on first use instead."""
+        return self.has_stt and (self.loader.lazy or self.loader.ready("stt"))
+
+    def listen_and_transcribe(self, audiopath="", audio=None) -> str:
         """
-        Listens to the audio file from path and return a transcription. The audio file is located in stt_generator/audio_outputs/record.wav by default.
+        Returns a transcription of the audio buffer if provided, otherwise of the audio file from path.
+        The audio file is located in stt_generator/audio_outputs/record.wav by default.
         """
-        if not audiopath:
-            audiopath = self.audio_capture.filepath
         if not self.has_stt:
             print("[Voice_Assistant] Cannot generate transcription without has_stt enabled.")
             return ""
+        if audio is None and not audiopath:
+            audiopath = self.audio_capture.filepath
         #self.audio_capture.run()
         self.is_generating=True
-        transcription = self.stt_module.generate_text_from_audio(audio_filepath=audiopath)
+        with metrics.span("assistant.transcribe") as span:
+            transcription = self.stt_module.generate_text_from_audio(audio_filepath=audiopath, audio=audio)
+            span.set(characters=len(transcription))
         self.is_generating=False
         return transcription
     
+    def listen_and_transcribe_incremental(self, on_partial=None) -> str:
+        """
+        Records the next utterance and transcribes it while the user is still speaking.
+        on_partial(text) receives the partial transcripts, only the last window is decoded at end of speech.
+        """
+        if not self.has_stt:
+            print("[Voice_Assistant] Cannot generate transcription without has_stt enabled.")
+            return ""
+        from stt_gen.streaming_stt import IncrementalTranscriber
+        transcriber = IncrementalTranscriber(self.stt_module, self.audio_capture.rate,
+                                             channels=self.audio_capture.channels, on_partial=on_partial)
+        transcriber.start()
+        self.audio_capture.record(on_chunk=transcriber.add_chunk)
+        self.is_generating=True
+        transcription = transcriber.finish()
+        self.is_generating=False
+        return transcription
+
     def generate_text_response(self, user_name, prompt) -> str:
         """
         Returns a response from the prompt.
@@ -49,10 +158,34 @@ class VoiceAssistant:
             print("[Voice_Assistant] Cannot generate text response without has_gen enabled.")
             return ""
         self.is_generating=True
-        response = self.generator.generate_response(prompt=prompt, user_name=user_name, save_to_history=False)
+        with metrics.span("assistant.text_response"):
+            response = self.generator.generate_response(prompt=prompt, user_name=user_name, save_to_history=False)
         self.is_generating=False
         return response
     
+    def generate_streamed_response(self, user_name, prompt) -> str:
+        """
+        Generates the response sentence by sentence and speaks each sentence as soon as it is complete,
+        while the rest of the reply is still being generated.
+        """
+        if not self.has_gen:
+            print("[Voice_Assistant] Cannot generate text response without has_gen enabled.")
+            return ""
+        self.is_generating=True
+        sentences = []
+        response_start_time = time.perf_counter()
+        with metrics.span("assistant.streamed_response") as span:
+            for sentence in self.generator.stream_sentences(prompt=prompt, user_name=user_name, save_to_history=False):
+                if not sentences:
+                    # Time until the first sentence can be spoken
+                    span.set(first_sentence_seconds=time.perf_counter() - response_start_time)
+                sentences.append(sentence)
+                if self.has_tts:
+                    self.tts_module.generate_audio(sentence)
+            span.set(sentences=len(sentences))
+        self.is_generating=False
+        return " ".join(sentences)
+
     def generate_audio_response(self, text, audiopath="") -> None:
         """
         Generates an audio file from the text provided in the audiopath. 
@@ -62,18 +195,38 @@ class VoiceAssistant:
             print("[Voice_Assistant] Cannot generate audio without has_tts enabled.")
             return
         self.is_generating=True
-        self.tts_module.generate_audio(text, output_file_path=audiopath)
+        with metrics.span("assistant.audio_response", characters=len(text)):
+            self.tts_module.generate_audio(text, output_file_path=audiopath)
         self.is_generating=False
     
+    def run_pipeline(self, user_name="Jun", listen_while_speaking=False, incremental_stt=False, report_every=0):
+        """
+        Runs the assistant as concurrent capture/STT/LLM/TTS/playback stages until interrupted.
+        Returns the pipeline so its per-stage stats can be inspected.
+        """
+        from assistant_pipeline import AssistantPipeline
+        self.pipeline = AssistantPipeline(self, user_name=user_name, listen_while_speaking=listen_while_speaking,
+                                          incremental_stt=incremental_stt)
+        self.pipeline.run_forever(report_every=report_every)
+        return self.pipeline
+
     #Mainly for standalone or debugging
     def generate_full_cycle_response(self):
-        if self.has_stt:
-            self.audio_capture.run()
-            user_input = self.listen_and_transcribe()
+        # Serve text input while Whisper is still loading
+        if self.stt_ready():
+            with metrics.span("assistant.capture") as span:
+                audio = self.audio_capture.capture()
+                span.set(samples=len(audio))
         else:
+            audio = None
             user_input = input("> ")
-        response = self.generate_text_response(user_name="Jun", prompt=user_input)
-        self.generate_audio_response(response)
+        with metrics.profile_turn(), metrics.span("assistant.turn"):
+            if audio is not None:
+                user_input = self.listen_and_transcribe(audio=audio)
+            if self.has_tts:
+                self.generate_streamed_response(user_name="Jun", prompt=user_input)
+            else:
+                self.generate_text_response(user_name="Jun", prompt=user_input)
 
 """
 ### DEBUGGING ###
@@ -0,0 +1,71 @@
+###IMPORTS###
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import metrics
+
+class ModelLoader:
+    '''
+    Loads the assistant models concurrently in a thread pool.
+    Each model is registered with a factory that does its own (heavy) imports, so nothing
+    is imported before it is needed. With lazy=True a model is only loaded on first use.
+    '''
+    def __init__(self, max_workers=3, lazy=False):
+        self.lazy = lazy
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model_loader")
+        self.factories = {}
+        self.futures = {}
+        self.load_times = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, factory):
+        self.factories[name] = factory
+
+    def load(self, name):
+        start_time = time.time()
+        print(f"\033[94m[Loader] Loading {name}...\033[0m")
+        with metrics.span("loader.load", model=name):
+            model = self.factories[name]()
+        self.load_times[name] = time.time() - start_time
+        return model
+
+    def submit(self, name):
+        with self.lock:
+            if name not in self.futures:
+                self.futures[name] = self.executor.submit(self.load, name)
+            return self.futures[name]
+
+    def start(self):
+        """Starts loading every registered model in the background, unless in lazy mode."""
+        if not self.lazy:
+            for name in self.factories:
+                self.submit(name)
+
+    def get(self, name, timeout=None):
+        """Returns the model, loading it or waiting for it to finish loading if needed."""
+        return self.submit(name).result(timeout=timeout)
+
+    def ready(self, name) -> bool:
+        future = self.futures.get(name)
+        return future is not None and future.done() and future.exception() is None
+
+    def wait_all(self, timeout=None):
+        for name in self.factories:
+            if name in self.futures:
+                self.futures[name].result(timeout=timeout)
+
+    def status(self) -> dict:
+        """Per-model readiness and load time in seconds."""
+        status = {}
+        for name in self.factories:
+            future = self.futures.get(name)
+            if future is None:
+                state = "not loaded"
+            elif not future.done():
+                state = "loading"
+            elif future.exception() is not None:
+                state = f"failed: {future.exception()}"
+            else:
+                state = "ready"
+            status[name] = {"state": state, "seconds": round(self.load_times.get(name, 0.0), 2)}
+        return status
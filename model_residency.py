@@ -0,0 +1,190 @@
+###IMPORTS###
+import ctypes
+import gc
+import sys
+import threading
+import time
+from instrumentation import metrics
+
+def module_bytes(*modules) -> int:
+    """
+    Bytes of the tensors in the state dicts of torch modules, tensors shared between them are counted once.
+    The state dict also holds the packed weights of dynamically quantized layers, which are neither
+    parameters nor buffers.
+    """
+    seen, total = set(), 0
+    for module in modules:
+        if module is None:
+            continue
+        for value in module.state_dict().values():
+            # Quantized Linear layers store their packed params as a (weight, bias) tuple
+            for tensor in (value if isinstance(value, (tuple, list)) else (value,)):
+                if not hasattr(tensor, "data_ptr") or tensor.data_ptr() in seen:
+                    continue
+                seen.add(tensor.data_ptr())
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+def current_rss_bytes() -> int:
+    """Current resident memory of the process, 0 when it can't be read."""
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            import os
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if "psutil" in sys.modules:
+        return sys.modules["psutil"].Process().memory_info().rss
+    return 0
+
+def free_memory():
+    """Collects the freed weights and gives the memory back to the OS / the GPU."""
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    if sys.platform.startswith("linux"):
+        try:
+            # glibc keeps freed arenas mapped, without this the RSS barely moves
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except OSError:
+            pass
+
+class ResidentModel:
+    '''
+    Mixin for the model wrappers whose weights can be freed while idle and loaded again on demand.
+    Subclasses implement load_weights(), free_weights() and weight_modules(), call init_residency(lock)
+    with the lock guarding their inferences, and call ensure_loaded() with that lock held before every use,
+    so the weights are never freed in the middle of an inference.
+    '''
+    def init_residency(self, lock):
+        self.residency_lock = lock
+        self.residency_manager = None
+        self.resident = True
+        self.last_used = time.time()
+        self.reloads = 0
+        # Bytes of the weights, kept while offloaded to plan the reload
+        self.footprint = module_bytes(*self.weight_modules())
+
+    def load_weights(self):
+        raise NotImplementedError
+
+    def free_weights(self):
+        raise NotImplementedError
+
+    def weight_modules(self) -> list:
+        raise NotImplementedError
+
+    def ensure_loaded(self):
+        self.last_used = time.time()
+        if self.resident:
+            return
+        if self.residency_manager is not None:
+            self.residency_manager.make_room(self)
+        with metrics.span("residency.reload", model=type(self).__name__) as span:
+            self.load_weights()
+            self.resident = True
+            self.reloads += 1
+            self.footprint = module_bytes(*self.weight_modules())
+            span.set(bytes=self.footprint)
+
+    def offload(self, blocking=True) -> bool:
+        """Frees the weights. Returns False when the model is in use and blocking is False."""
+        if not self.residency_lock.acquire(blocking=blocking):
+            return False
+        try:
+            if self.resident:
+                with metrics.span("residency.offload", model=type(self).__name__, bytes=self.footprint):
+                    self.free_weights()
+                    self.resident = False
+                    free_memory()
+        finally:
+            self.residency_lock.release()
+        return True
+
+class ResidencyManager:
+    '''
+    Keeps the weights of the registered models under a memory budget.
+    Before a model is reloaded, the least recently used idle models are offloaded until its footprint fits
+    in budget_bytes (0 for no budget). Models idle for longer than their idle_ttl (seconds, 0 to keep them)
+    are offloaded by a background thread. A model in use is never offloaded.
+    '''
+    def __init__(self, budget_bytes=0, idle_ttl=0, check_interval=5.0):
+        self.budget_bytes = budget_bytes
+        # One TTL for every model or {name: ttl}
+        self.idle_ttl = idle_ttl
+        self.check_interval = check_interval
+        self.models = {}
+        self.ttls = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def register(self, name, model, idle_ttl=None):
+        if idle_ttl is None:
+            idle_ttl = self.idle_ttl.get(name, 0) if isinstance(self.idle_ttl, dict) else self.idle_ttl
+        model.residency_manager = self
+        with self.lock:
+            self.models[name] = model
+            self.ttls[name] = idle_ttl
+        if idle_ttl and self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="residency", daemon=True)
+            self.thread.start()
+        # Models are loaded at start without asking for room
+        self.make_room(None)
+
+    def resident_bytes(self) -> int:
+        return sum(model.footprint for model in self.models.values() if model.resident)
+
+    def make_room(self, model):
+        """Offloads idle models, least recently used first, until model fits in the budget."""
+        if not self.budget_bytes:
+            return
+        needed = model.footprint if model is not None else 0
+        with self.lock:
+            candidates = sorted((other for other in self.models.values() if other is not model and other.resident),
+                                key=lambda other: other.last_used)
+            for other in candidates:
+                if self.resident_bytes() + needed <= self.budget_bytes:
+                    break
+                other.offload(blocking=False)
+            if self.resident_bytes() + needed > self.budget_bytes:
+                print(f"[Residency] \033[91mOver budget: {(self.resident_bytes() + needed) / 2**20:.0f} MB resident for "
+                      f"{self.budget_bytes / 2**20:.0f} MB, the other models are in use.\033[0m")
+
+    def check_idle(self):
+        now = time.time()
+        with self.lock:
+            idle = [model for name, model in self.models.items()
+                    if self.ttls[name] and model.resident and now - model.last_used > self.ttls[name]]
+        for model in idle:
+            model.offload(blocking=False)
+
+    def run(self):
+        while not self.stop_event.wait(self.check_interval):
+            self.check_idle()
+
+    def usage(self) -> dict:
+        """Per-model residency and footprint, the total of the resident weights and the process RSS, in bytes."""
+        now = time.time()
+        with self.lock:
+            models = {
+                name: {
+                    "resident": model.resident,
+                    "bytes": model.footprint,
+                    "idle_seconds": round(now - model.last_used, 1),
+                    "reloads": model.reloads,
+                }
+                for name, model in self.models.items()
+            }
+            return {
+                "models": models,
+                "resident_bytes": self.resident_bytes(),
+                "budget_bytes": self.budget_bytes,
+                "process_rss_bytes": current_rss_bytes(),
+            }
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
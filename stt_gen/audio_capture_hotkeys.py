@@ -1,13 +1,15 @@
 from pynput import keyboard
 from pathlib import Path
+import threading
+import numpy as np
 import pyaudio
-import wave
+from stt_gen.audio_utils import pcm16_to_float32, downmix, resample, write_wav
 
 class Audio_Listener(keyboard.Listener):
     def __init__(self, recorder):
         super().__init__(on_press = self.on_press, on_release = self.on_release)
         self.recorder = recorder
-    
+
     def on_press(self, key):
         if key is None: #unknown event
             pass
@@ -18,8 +20,9 @@ class Audio_Listener(keyboard.Listener):
             if key.char == 'q': #press q to quit
                 if self.recorder.recording:
                     self.recorder.stop()
-                raise Exception("Chat stopped.")
-                
+                print("Chat stopped.")
+                return False #stops the listener, the recorder can be reused
+
     def on_release(self, key):
         if key is None:
             pass
@@ -30,56 +33,133 @@ class Audio_Listener(keyboard.Listener):
             pass
 
 class recorder:
-    def __init__(self, wavfile, chunksize=2048, dataformat=pyaudio.paInt16, channels=2, rate=44100):
+    """
+    Push-to-talk capture engine, start() and stop() can be called any number of times.
+    The PyAudio callback only copies the int16 samples into a ring buffer allocated once for max_seconds:
+    a longer recording keeps its last max_seconds. stop() converts the recording to float32 mono at target_rate,
+    ready for the STT model, and also passes it to on_audio(audio) when given.
+    Writing wavfile (relative to this directory) is an optional debug side effect.
+    overruns / underruns count the callbacks PortAudio flagged with an input overflow / underflow,
+    dropped_samples the samples overwritten because the recording was longer than the ring buffer.
+    """
+    def __init__(self, wavfile="", chunksize=2048, dataformat=pyaudio.paInt16, channels=2, rate=44100,
+                 target_rate=16000, max_seconds=120, input_device_index=None, on_audio=None):
+        if dataformat != pyaudio.paInt16:
+            raise ValueError("Only 16-bit PCM capture is supported.")
         self.this_dir = Path(__file__).parent.resolve()
-        self.filename = str(self.this_dir) + wavfile
+        self.filename = str(self.this_dir) + wavfile if wavfile else ""
         self.chunksize = chunksize
         self.dataformat = dataformat
         self.channels = channels
         self.rate = rate
+        self.target_rate = target_rate
+        self.input_device_index = input_device_index
+        self.on_audio = on_audio
         self.recording = False
+        self.lock = threading.Lock()
+        # Interleaved samples, allocated once and reused by every recording
+        self.buffer = np.zeros(int(max_seconds * rate) * channels, dtype=np.int16)
+        self.write_pos = 0
+        self.recorded = 0
+        self.overruns = 0
+        self.underruns = 0
+        self.dropped_samples = 0
+        self.last_audio = np.zeros(0, dtype=np.float32)
         self.pa = pyaudio.PyAudio()
+        self.stream = None
+
+    def callback(self, in_data, frame_count, time_info, status):
+        if status & pyaudio.paInputOverflow:
+            self.overruns += 1
+        if status & pyaudio.paInputUnderflow:
+            self.underruns += 1
+        samples = np.frombuffer(in_data, dtype=np.int16)
+        capacity = len(self.buffer)
+        if len(samples) > capacity:
+            samples = samples[-capacity:]
+        first = min(len(samples), capacity - self.write_pos)
+        self.buffer[self.write_pos:self.write_pos + first] = samples[:first]
+        self.buffer[:len(samples) - first] = samples[first:]
+        self.write_pos = (self.write_pos + len(samples)) % capacity
+        self.recorded += len(samples)
+        return (None, pyaudio.paContinue)
 
     def start(self):
-        # we call start and stop from the keyboard listener, so we use the asynchronous 
-        # version of pyaudio streaming. The keyboard listener must regain control to 
+        # we call start and stop from the keyboard listener, so we use the asynchronous
+        # version of pyaudio streaming. The keyboard listener must regain control to
         # begin listening again for the key release.
-        if not self.recording:
-            self.wf = wave.open(self.filename, 'wb')
-            self.wf.setnchannels(self.channels)
-            self.wf.setsampwidth(self.pa.get_sample_size(self.dataformat))
-            self.wf.setframerate(self.rate)
-            
-            def callback(in_data, frame_count, time_info, status):
-                #file write should be able to keep up with audio data stream (about 1378 Kbps)
-                self.wf.writeframes(in_data) 
-                return (in_data, pyaudio.paContinue)
-            
-            self.stream = self.pa.open(format = self.dataformat,
-                                       channels = self.channels,
-                                       rate = self.rate,
-                                       input = True,
-                                       stream_callback = callback)
+        with self.lock:
+            if self.recording:
+                return
+            self.write_pos = 0
+            self.recorded = 0
+            if self.stream is None:
+                # Opened once, only started and stopped between recordings
+                self.stream = self.pa.open(format = self.dataformat,
+                                           channels = self.channels,
+                                           rate = self.rate,
+                                           input = True,
+                                           input_device_index = self.input_device_index,
+                                           frames_per_buffer = self.chunksize,
+                                           stream_callback = self.callback,
+                                           start = False)
             self.stream.start_stream()
             self.recording = True
             print('recording started...')
-    
+
     def stop(self):
-        if self.recording:         
+        """Stops the recording and returns it as float32 mono samples at target_rate."""
+        with self.lock:
+            if not self.recording:
+                return self.last_audio
+            # No callback runs once the stream is stopped
             self.stream.stop_stream()
-            self.stream.close()
-            self.wf.close()
-            
             self.recording = False
-            print('recording finished...')
-            exit()
+            self.last_audio = self.to_model_input(self.recorded_samples())
+            print(f'recording finished... {len(self.last_audio) / self.target_rate:.2f} seconds')
+        if self.filename:
+            write_wav(self.filename, self.last_audio, self.target_rate)
+        if self.on_audio is not None:
+            self.on_audio(self.last_audio)
+        return self.last_audio
+
+    def recorded_samples(self):
+        """The int16 samples of the last recording in order, whole frames only."""
+        capacity = len(self.buffer)
+        if self.recorded > capacity:
+            self.dropped_samples += self.recorded - capacity
+            samples = np.concatenate((self.buffer[self.write_pos:], self.buffer[:self.write_pos]))
+        else:
+            samples = self.buffer[:self.recorded]
+        return samples[:len(samples) - len(samples) % self.channels]
+
+    def to_model_input(self, samples):
+        audio = downmix(pcm16_to_float32(samples), self.channels)
+        return resample(audio, self.rate, self.target_rate)
+
+    def stats(self) -> dict:
+        return {"overruns": self.overruns, "underruns": self.underruns, "dropped_samples": self.dropped_samples}
+
+    def close(self):
+        if self.recording:
+            self.stop()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.pa.terminate()
 
-def run():
-    r = recorder("/audio_outputs/record.wav")
+def run(stt_module=None):
+    """Push-to-talk loop, every recording is transcribed when a SpeechToTextGenerator is given."""
+    on_audio = None
+    if stt_module is not None:
+        on_audio = lambda audio: print(stt_module.generate_text_from_audio(audio=audio, sampling_rate=16000))
+    r = recorder("/audio_outputs/record.wav", target_rate=16000, on_audio=on_audio)
     l = Audio_Listener(r)
     print('Hold Home to record, press q to quit')
     l.start() #keyboard listener is a thread so we start it here
     l.join() #wait for the tread to terminate
+    print(r.stats())
+    r.close()
 
 ###DEBUGGING###
 #run()
@@ -1,14 +1,15 @@
 import pyaudio
-import wave
 import numpy as np
-import time
 from pathlib import Path
+from stt_gen.audio_utils import to_model_input, write_wav
+from stt_gen.vad import make_vad, SPEECH_START, SPEECH_END
 
 class AudioCapture:
     """
     Base class for capturing audio from an external device.
     """
-    def __init__(self, input_device_name="", filepath=""):
+    def __init__(self, input_device_name="", filepath="", target_rate=16000, save_debug_wav=False,
+                 vad=None, end_of_speech_ms=700, max_speech_ms=None):
         super().__init__()
         if filepath == "":
             this_dir = str(Path(__file__).parent.resolve())
@@ -33,10 +34,17 @@ class AudioCapture:
         self.channels = 1                                               
         # Sampling rate in Hertz (samples per second)
         self.rate = 24000                                               
-        # Threshold for detecting voice
+        # Threshold for detecting voice with is_silent()
         self.threshold = 330                                            
-        # Duration to wait in seconds after voice stops
-        self.silence_duration = 3                                       
+        # Voice activity detector deciding when an utterance starts and ends.
+        # Any VoiceActivityDetector can be plugged in, the adaptive one is used by default.
+        # Utterances are not cut unless max_speech_ms is given, long dictations use the long-form STT mode.
+        self.vad = vad if vad is not None else make_vad("adaptive", self.rate, end_of_speech_ms=end_of_speech_ms,
+                                                         max_speech_ms=max_speech_ms)
+        # Sampling rate expected by the STT model
+        self.target_rate = target_rate
+        # Also write the captured audio to filepath when using capture()
+        self.save_debug_wav = save_debug_wav
     
     def is_silent(self, data):
         """Check if the audio data is below the silence threshold."""
@@ -53,7 +61,11 @@ class AudioCapture:
                 return i
         raise ModuleNotFoundError("Input device not found.")
 
-    def run(self):
+    def record(self, on_chunk=None):
+        """
+        Record one utterance from the input device and return the raw int16 frames.
+        on_chunk(data) is called with every chunk of the utterance while it is being recorded.
+        """
         # Open the stream for audio input
         stream = self.audio.open(format=self.format, channels=self.channels,
                             rate=self.rate, input=True,
@@ -64,43 +76,69 @@ class AudioCapture:
 
         recording = False  # Flag to check if we are recording
         frames = []  # List to store audio frames
-        silence_start_time = None
+        self.vad.reset()
 
         try:
             while True:
                 # Read a chunk of data from the microphone
                 data = stream.read(self.chunk)
+                event = self.vad.process(data)
 
-                if not recording and not self.is_silent(data):
+                if event == SPEECH_START:
                     print("Voice detected. Recording started.")
                     recording = True
-                    frames = [data]  # Start recording with this chunk
+                    # Start recording with the audio right before the voice was detected
+                    frames = self.vad.take_pre_roll() + [data]
+                    if on_chunk is not None:
+                        for frame in frames:
+                            on_chunk(frame)
 
                 elif recording:
                     frames.append(data)
-                    if self.is_silent(data):
-                        if silence_start_time is None:
-                            silence_start_time = time.time()
-                        elif time.time() - silence_start_time > self.silence_duration:
-                            print("Silence detected. Recording stopped.")
-                            break  # Stop recording
-                    else:
-                        silence_start_time = None  # Reset the silence timer if voice is detected
+                    if on_chunk is not None:
+                        on_chunk(data)
+                    if event == SPEECH_END:
+                        print("Silence detected. Recording stopped.")
+                        # Drop the trailing silence beyond the VAD hangover
+                        chunk_ms = 1000.0 * self.chunk / self.rate
+                        trim_chunks = min(int(self.vad.trim_ms // chunk_ms), len(frames) - 1)
+                        if trim_chunks > 0:
+                            frames = frames[:-trim_chunks]
+                        break  # Stop recording
 
         finally:
             # Stop and close the stream
             stream.stop_stream()
             stream.close()
+        return frames
+
+    def save(self, frames, filepath=""):
+        """Save raw int16 frames in a WAV file, by default in self.filepath."""
+        if not filepath:
+            filepath = self.filepath
+        write_wav(filepath, b''.join(frames), self.rate, self.channels)
+        print(f"\nAudio saved in {filepath}\n")
+
+    def run(self):
+        """Record one utterance and save it in self.filepath."""
+        frames = self.record()
+        # Save the recorded data to a WAV file if there is any recorded audio
+        if frames:
+            self.save(frames)
 
-            # Save the recorded data to a WAV file if there is any recorded audio
-            if frames:
-                wf = wave.open(self.filepath, 'wb')
-                wf.setnchannels(self.channels)
-                wf.setsampwidth(self.audio.get_sample_size(self.format))
-                wf.setframerate(self.rate)
-                wf.writeframes(b''.join(frames))
-                wf.close()
-                print(f"\nAudio saved in {self.filepath}\n")
+    def capture(self, save_wav=None, on_chunk=None):
+        """
+        Record one utterance and return it as a contiguous float32 mono buffer at self.target_rate,
+        ready to be passed to the STT model. Writing the WAV file is only an optional debug side effect.
+        """
+        frames = self.record(on_chunk=on_chunk)
+        if not frames:
+            return np.zeros(0, dtype=np.float32)
+        if save_wav is None:
+            save_wav = self.save_debug_wav
+        if save_wav:
+            self.save(frames)
+        return to_model_input(frames, self.rate, self.target_rate, self.channels)
 
 
 """
@@ -0,0 +1,126 @@
+"""
+Small numpy helpers shared by the capture modules and the STT generator.
+Everything here works on whole buffers at once so a turn is converted in a single pass.
+"""
+import struct
+import wave
+import numpy as np
+
+def pcm16_to_float32(data):
+    """Convert little endian int16 PCM (bytes or array) to float32 samples in [-1, 1]."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = np.frombuffer(data, dtype=np.int16)
+    return data.astype(np.float32) / 32768.0
+
+def float32_to_pcm16(audio):
+    """Convert float32 samples in [-1, 1] to int16 PCM."""
+    return (np.clip(audio, -1.0, 1.0) * 32767.0).astype(np.int16)
+
+def downmix(audio, channels):
+    """Average interleaved channels of a 1-D buffer into mono."""
+    if channels <= 1:
+        return audio
+    usable = len(audio) - len(audio) % channels
+    return audio[:usable].reshape(-1, channels).mean(axis=1, dtype=np.float32)
+
+def lowpass_kernel(cutoff, num_taps=63):
+    """Windowed-sinc low-pass FIR. cutoff is relative to the input rate (0 < cutoff <= 0.5)."""
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(num_taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+def resample(audio, orig_rate, target_rate):
+    """
+    Resample a mono float32 buffer in one vectorized pass.
+    When downsampling, a low-pass filter is applied first to avoid aliasing.
+    """
+    if orig_rate == target_rate or len(audio) == 0:
+        return np.ascontiguousarray(audio, dtype=np.float32)
+    if target_rate < orig_rate:
+        audio = np.convolve(audio, lowpass_kernel(0.5 * target_rate / orig_rate), mode="same")
+    duration = len(audio) / orig_rate
+    target_length = int(round(duration * target_rate))
+    source_times = np.arange(len(audio)) / orig_rate
+    target_times = np.arange(target_length) / target_rate
+    return np.interp(target_times, source_times, audio).astype(np.float32)
+
+def to_model_input(frames, orig_rate, target_rate=16000, channels=1):
+    """Join raw int16 frames and return a contiguous float32 mono buffer at target_rate."""
+    audio = pcm16_to_float32(b''.join(frames) if isinstance(frames, list) else frames)
+    audio = downmix(audio, channels)
+    return resample(audio, orig_rate, target_rate)
+
+def write_wav(filepath, data, rate, channels=1):
+    """Write int16 PCM (bytes or array) into a WAV file."""
+    if isinstance(data, np.ndarray):
+        if data.dtype != np.int16:
+            data = float32_to_pcm16(data)
+        data = data.tobytes()
+    wf = wave.open(str(filepath), 'wb')
+    wf.setnchannels(channels)
+    wf.setsampwidth(2)
+    wf.setframerate(rate)
+    wf.writeframes(data)
+    wf.close()
+
+def read_wav(filepath):
+    """
+    Read a 16-bit PCM or 32-bit float WAV file (the latter is what torchaudio writes by default).
+    Returns (float32 mono samples, rate).
+    """
+    with open(filepath, 'rb') as file:
+        data = file.read()
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise ValueError(f"{filepath} is not a WAV file.")
+    offset, fmt, samples = 12, None, None
+    while offset + 8 <= len(data):
+        chunk_id, chunk_size = struct.unpack('<4sI', data[offset:offset + 8])
+        body = data[offset + 8:offset + 8 + chunk_size]
+        if chunk_id == b'fmt ':
+            fmt = body
+        elif chunk_id == b'data':
+            samples = body
+        offset += 8 + chunk_size + chunk_size % 2
+    if fmt is None or samples is None:
+        raise ValueError(f"{filepath} has no fmt or data chunk.")
+    format_tag, channels, rate, _, _, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag == 0xFFFE and len(fmt) >= 26:
+        # WAVE_FORMAT_EXTENSIBLE, the actual format is the start of the sub format GUID
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    if format_tag == 1 and bits == 16:
+        audio = pcm16_to_float32(samples[:len(samples) - len(samples) % 2])
+    elif format_tag == 3 and bits == 32:
+        audio = np.frombuffer(samples[:len(samples) - len(samples) % 4], dtype='<f4').astype(np.float32)
+    else:
+        raise ValueError(f"{filepath}: unsupported WAV format {format_tag} with {bits} bits.")
+    return downmix(audio, channels), rate
+
+def wav_duration(source):
+    """
+    Duration in seconds of a WAV file (path or encoded bytes) read from its header only.
+    Returns None when the source is not a WAV file.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        import io
+        stream = io.BytesIO(source)
+    else:
+        stream = open(source, 'rb')
+    with stream:
+        header = stream.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+        block_align, rate = None, None
+        while True:
+            chunk_header = stream.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt = stream.read(chunk_size + chunk_size % 2)
+                _, _, rate, _, block_align = struct.unpack('<HHIIH', fmt[:14])
+            elif chunk_id == b'data':
+                if not block_align or not rate:
+                    return None
+                return chunk_size / block_align / rate
+            else:
+                stream.seek(chunk_size + chunk_size % 2, 1)
@@ -0,0 +1,139 @@
+import threading
+from transformers import StoppingCriteria, StoppingCriteriaList
+from stt_gen.audio_utils import to_model_input
+from instrumentation import metrics
+
+class CancelStaleDecode(StoppingCriteria):
+    '''Stops a partial decode once the utterance ended, unless it already covers the whole utterance.'''
+    def __init__(self, transcriber, samples):
+        self.transcriber = transcriber
+        self.samples = samples
+        self.cancelled = False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+        self.cancelled = self.transcriber.stop_event.is_set() and self.transcriber.total_samples > self.samples
+        return torch.full((input_ids.shape[0],), self.cancelled, dtype=torch.bool, device=input_ids.device)
+
+class IncrementalTranscriber:
+    """
+    Transcribes an utterance while it is still being recorded.
+    Chunks are added with add_chunk() from the capture loop, and a background thread re-runs Whisper
+    every interval_s on the audio that is not committed yet. A segment is committed (its text is final and
+    its audio is dropped from the next decodes) once two consecutive hypotheses agree on it and it ends
+    more than commit_margin_s before the end of the buffer. finish() then only has to decode the last window.
+    A partial decode still running at the end of speech is cancelled, or kept as the final transcript when it
+    already covers all the audio, so finish() never waits for a decode it then throws away.
+    """
+    def __init__(self, stt, rate, channels=1, interval_s=1.0, commit_margin_s=1.0, max_window_s=20.0, on_partial=None):
+        self.stt = stt
+        self.rate = rate
+        self.channels = channels
+        self.interval_s = interval_s
+        self.commit_margin_s = commit_margin_s
+        self.max_window_s = max_window_s
+        # on_partial(text) receives the committed text followed by the current hypothesis
+        self.on_partial = on_partial
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        self.chunks = []
+        self.total_samples = 0
+        # Samples (per channel, at the capture rate) already covered by committed text
+        self.committed_samples = 0
+        self.committed_text = []
+        self.previous_segments = []
+        self.decoded_samples = 0
+        # Samples covered by previous_segments, the last complete hypothesis
+        self.hypothesis_samples = 0
+        self.partial_decodes = 0
+        self.cancelled_decodes = 0
+
+    def start(self):
+        self.reset()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.decode_loop, daemon=True)
+        self.thread.start()
+
+    def add_chunk(self, data:bytes):
+        with self.lock:
+            self.chunks.append(data)
+            self.total_samples += len(data) // 2 // self.channels
+
+    def pending_audio(self):
+        """
+        Returns (float32 audio at the model rate, offset, total) for the uncommitted part of the buffer,
+        offset and total being the samples committed and recorded so far.
+        """
+        with self.lock:
+            pcm = b''.join(self.chunks)
+            offset = self.committed_samples
+            total = self.total_samples
+        pcm = pcm[offset * 2 * self.channels:]
+        return to_model_input(pcm, self.rate, self.stt.sampling_rate, self.channels), offset, total
+
+    def decode_loop(self):
+        while not self.stop_event.wait(self.interval_s):
+            if self.total_samples - self.decoded_samples < self.rate * self.interval_s / 2:
+                continue
+            audio, offset, total = self.pending_audio()
+            self.decoded_samples = total
+            if len(audio) == 0:
+                continue
+            cancel = CancelStaleDecode(self, total)
+            segments = self.stt.transcribe_segments(audio, stopping_criteria=StoppingCriteriaList([cancel]))
+            if cancel.cancelled:
+                # Truncated hypothesis, finish() decodes the audio again
+                self.cancelled_decodes += 1
+                break
+            self.partial_decodes += 1
+            self.commit(segments, offset, len(audio) / self.stt.sampling_rate)
+            self.hypothesis_samples = total
+            if self.on_partial is not None:
+                self.on_partial(self.text(self.previous_segments))
+
+    def commit(self, segments, offset, duration):
+        """Commits the leading segments agreed by the last two hypotheses and far enough from the buffer end."""
+        agreed = 0
+        for previous, current in zip(self.previous_segments, segments):
+            end = current["timestamp"][1]
+            if end is None or end > duration - self.commit_margin_s:
+                break
+            if previous["text"].strip() != current["text"].strip():
+                break
+            agreed += 1
+        # Without agreement, keep the window bounded by committing everything but the last segment
+        if agreed == 0 and duration > self.max_window_s and len(segments) > 1 and segments[-2]["timestamp"][1]:
+            agreed = len(segments) - 1
+        if agreed:
+            end = segments[agreed - 1]["timestamp"][1]
+            with self.lock:
+                self.committed_text.extend(segment["text"].strip() for segment in segments[:agreed])
+                self.committed_samples = offset + int(end * self.rate)
+            segments = segments[agreed:]
+        self.previous_segments = segments
+
+    def text(self, segments=()) -> str:
+        return " ".join(self.committed_text + [segment["text"].strip() for segment in segments]).strip()
+
+    def finish(self) -> str:
+        """Stops the partial decodes and decodes the remaining uncommitted audio. Returns the final transcript."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        with metrics.span("stt.finalize", partial_decodes=self.partial_decodes, cancelled_decodes=self.cancelled_decodes,
+                          committed_segments=len(self.committed_text)) as span:
+            reused = self.partial_decodes > 0 and self.hypothesis_samples == self.total_samples
+            span.set(reused_hypothesis=reused)
+            if reused:
+                # The last partial decode already saw every sample of the utterance
+                transcript = self.text(self.previous_segments)
+            else:
+                audio, _, _ = self.pending_audio()
+                segments = self.stt.transcribe_segments(audio) if len(audio) > self.stt.sampling_rate * 0.1 else []
+                transcript = self.text(segments)
+        print(f"\n\033[092m {transcript} \033[0m \n")
+        return transcript
@@ -1,72 +1,250 @@
 ###IMPORTS###
 import torch
+import struct
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from pathlib import Path
 from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
+from transformers.pipelines.audio_utils import ffmpeg_read
+from stt_gen.audio_utils import read_wav, resample, wav_duration
+from cpu_profile import ModelProfile
+from instrumentation import metrics
+from model_residency import ResidentModel
 
 #import warnings
 #warnings.catch_warnings(action="ignore")
 
-class SpeechToTextGenerator:
+class SpeechToTextGenerator(ResidentModel):
     """
     Base class for transcribing speech into text.
+    The processor and the ASR pipeline are built once in setup() and reused for every call.
+    The weights can be offloaded while idle, they are loaded again on the next transcription.
+    Audio longer than long_form_threshold_s is split in chunk_length_s windows overlapping by stride_length_s
+    on each side, decoded batch_size windows at a time, and the timestamps of the windows are merged.
     """
-    def __init__(self):
+    def __init__(self, model_id="openai/whisper-small", warmup=True, cpu_profile=None,
+                 chunk_length_s=30.0, stride_length_s=5.0, batch_size=4, long_form_threshold_s=30.0):
         self.this_dir = Path(__file__).parent.resolve()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
-        self.model_id = "openai/whisper-small"
-        self.model = AutoModelForSpeechSeq2Seq.from_pretrained(self.model_id, 
-                                                          torch_dtype=self.torch_dtype, 
-                                                          low_cpu_mem_usage=True, 
-                                                          use_safetensors=True)
+        self.model_id = model_id
+        # Whisper models expect 16 kHz mono audio
+        self.sampling_rate = 16000
+        self.default_generate_kwargs = {
+            "max_new_tokens": 256,
+            "return_timestamps": True
+        }
+        # Long-form mode, Whisper sees at most 30 seconds at once
+        self.chunk_length_s = chunk_length_s
+        self.stride_length_s = stride_length_s
+        self.batch_size = batch_size
+        self.long_form_threshold_s = long_form_threshold_s
+        # The pipeline is not safe to call from several threads at once
+        self.lock = threading.Lock()
+        # CPU optimizations (quantization, threads...), a no-op profile by default
+        self.cpu_profile = cpu_profile or ModelProfile()
+        # Seconds spent in the pipeline for the last transcription
+        self.last_latency = 0.0
         #load model to gpu/cpu
-        self.setup()
-
-    def setup(self):
-        # Set a timer to calculate load times
-        generate_start_time = time.time() 
+        self.setup(warmup=warmup)
 
-        # Start loading the correct model as set by "tts_method_xtts_local"
+    def setup(self, warmup=True):
         print(f"\033[94mWhisperSTT Local Loading\033[0m {self.model_id} \033[94minto\033[93m {self.device}\033[0m")
-        self.model.to(self.device)
+        with metrics.span("stt.load", model=self.model_id, device=self.device):
+            # The processor is small and kept when the weights are offloaded
+            self.processor = AutoProcessor.from_pretrained(self.model_id)
+            self.sampling_rate = self.processor.feature_extractor.sampling_rate
+            self.load_weights()
+        self.init_residency(self.lock)
 
-        # Create an end timer for calculating load times
-        generate_end_time = time.time()
-        generate_elapsed_time = generate_end_time - generate_start_time
-        print(f"\033[94mWhisper model loaded in \033[93m{generate_elapsed_time:.2f} seconds.\033[0m")
-
-        
-    def generate_text_from_audio(self, audio_filepath="", **generate_kwargs):
-        if audio_filepath == "":
-            audio_filepath = f"{self.this_dir}/audio_outputs/record.wav"
-        processor = AutoProcessor.from_pretrained(self.model_id)
-        pipe = pipeline(
+        if warmup:
+            self.warmup()
+
+    def load_weights(self):
+        # safetensors weights are memory-mapped, a reload mostly reads from the page cache
+        self.model = AutoModelForSpeechSeq2Seq.from_pretrained(self.model_id,
+                                                          torch_dtype=self.torch_dtype,
+                                                          low_cpu_mem_usage=True,
+                                                          use_safetensors=True)
+        self.model.to(self.device)
+        self.model = self.cpu_profile.apply(self.model, self.device)
+        self.pipe = pipeline(
             "automatic-speech-recognition",
             model=self.model,
-            tokenizer=processor.tokenizer,
-            feature_extractor=processor.feature_extractor,
+            tokenizer=self.processor.tokenizer,
+            feature_extractor=self.processor.feature_extractor,
             torch_dtype=self.torch_dtype,
             device=self.device
         )
 
+    def free_weights(self):
+        self.pipe = None
+        self.model = None
+
+    def weight_modules(self) -> list:
+        return [self.model]
+
+    def warmup(self, seconds=1.0):
+        """
+        Runs a silent dummy clip through the pipeline so the first real utterance
+        does not pay for lazy initialisation (kernel selection, allocator growth...).
+        """
+        with metrics.span("stt.warmup"):
+            dummy = np.zeros(int(self.sampling_rate * seconds), dtype=np.float32)
+            self.run_pipeline({"raw": dummy, "sampling_rate": self.sampling_rate}, {"max_new_tokens": 4})
+
+    def prepare_input(self, audio, sampling_rate=None):
+        """
+        Converts the accepted audio inputs into something the ASR pipeline can consume.
+        - str / Path: path to an audio file, decoded by the pipeline.
+        - bytes: encoded audio file contents (wav, flac...), decoded by the pipeline.
+        - numpy array: raw samples, int16 or float. sampling_rate defaults to the model rate.
+        """
+        if isinstance(audio, Path):
+            return str(audio)
+        if isinstance(audio, (str, bytes)):
+            return audio
+        if isinstance(audio, np.ndarray):
+            if audio.dtype == np.int16:
+                audio = audio.astype(np.float32) / 32768.0
+            elif audio.dtype != np.float32:
+                audio = audio.astype(np.float32)
+            if audio.ndim > 1:
+                # Downmix (samples, channels) to mono
+                audio = audio.mean(axis=1)
+            return {"raw": np.ascontiguousarray(audio),
+                    "sampling_rate": sampling_rate or self.sampling_rate}
+        raise TypeError(f"Unsupported audio input type: {type(audio).__name__}")
+
+    def run_pipeline(self, inputs, generate_kwargs, **pipe_kwargs):
+        with metrics.span("stt.inference") as span:
+            if isinstance(inputs, dict):
+                span.set(samples=len(inputs["raw"]), audio_seconds=len(inputs["raw"]) / inputs["sampling_rate"])
+            wait_start_time = time.perf_counter()
+            with self.lock, self.cpu_profile.thread_scope():
+                span.set(lock_wait_seconds=time.perf_counter() - wait_start_time)
+                self.ensure_loaded()
+                return self.pipe(inputs, batch_size=pipe_kwargs.pop("batch_size", 1), generate_kwargs=generate_kwargs, **pipe_kwargs)
+
+    def audio_seconds(self, inputs):
+        """Duration of raw audio or of a WAV file (from its header), None for the other formats."""
+        if isinstance(inputs, dict):
+            return len(inputs["raw"]) / inputs["sampling_rate"]
+        try:
+            return wav_duration(inputs)
+        except (OSError, struct.error):
+            return None
+
+    def run_long_form(self, inputs, generate_kwargs, batch_size=None):
+        """Decodes the overlapping windows in batches, the pipeline merges their text and timestamps."""
+        with metrics.span("stt.long_form", batch_size=batch_size or self.batch_size):
+            return self.run_pipeline(inputs, dict(generate_kwargs, return_timestamps=True),
+                                     chunk_length_s=self.chunk_length_s,
+                                     stride_length_s=self.stride_length_s,
+                                     batch_size=batch_size or self.batch_size)
+
+    def transcribe(self, inputs, generate_kwargs, batch_size=None):
+        """Single pass for short audio, long-form mode above long_form_threshold_s."""
+        seconds = self.audio_seconds(inputs)
+        if seconds is None:
+            # Other formats are decoded here to know their length
+            inputs = {"raw": self.load_audio(inputs), "sampling_rate": self.sampling_rate}
+            seconds = self.audio_seconds(inputs)
+        if seconds > self.long_form_threshold_s:
+            return self.run_long_form(inputs, generate_kwargs, batch_size)
+        return self.run_pipeline(inputs, generate_kwargs)
+
+    def transcribe_segments(self, audio, sampling_rate=None, **generate_kwargs) -> list:
+        """
+        Returns the timestamped segments of the audio as a list of {"timestamp": (start, end), "text": str}.
+        The end of the last segment can be None when Whisper did not predict it.
+        generate_kwargs are added to the default ones, e.g. stopping_criteria to cancel the decode.
+        """
+        result = self.transcribe(self.prepare_input(audio, sampling_rate),
+                                 dict(self.default_generate_kwargs, return_timestamps=True, **generate_kwargs))
+        return result.get("chunks") or [{"timestamp": (0.0, None), "text": result["text"]}]
+
+    def generate_text_from_audio(self, audio_filepath="", audio=None, sampling_rate=None, **generate_kwargs):
+        if audio is None:
+            if audio_filepath == "":
+                audio_filepath = f"{self.this_dir}/audio_outputs/record.wav"
+            audio = audio_filepath
+        inputs = self.prepare_input(audio, sampling_rate)
+
         if len(generate_kwargs) == 0:
-            generate_kwargs = {
-                "max_new_tokens": 256,
-                "return_timestamps": True
-            }
+            generate_kwargs = dict(self.default_generate_kwargs)
 
         generate_start_time = time.time()
-        result = pipe(audio_filepath, batch_size=1, generate_kwargs=generate_kwargs) #add parameter generate_kwargs=generate_kwargs
+        result = self.transcribe(inputs, generate_kwargs)
         generate_end_time = time.time()
         generated_time = generate_end_time - generate_start_time
-        print(f"[WHISPER_TTS] Generated result in \033[93m {generated_time:.2f} seconds.\033[0m")
+        self.last_latency = generated_time
         print(f"\n\033[092m {result['text']} \033[0m \n")
         return result['text']
 
+    ### BULK TRANSCRIPTION ###
+    def load_audio(self, source):
+        """Decodes an audio file (path or encoded bytes) into float32 mono samples at the model rate, WAV files without ffmpeg."""
+        if isinstance(source, (bytes, bytearray)):
+            return ffmpeg_read(bytes(source), self.sampling_rate)
+        filepath = Path(source)
+        if filepath.suffix.lower() == ".wav":
+            audio, rate = read_wav(filepath)
+            return resample(audio, rate, self.sampling_rate)
+        with open(filepath, "rb") as audio_file:
+            return ffmpeg_read(audio_file.read(), self.sampling_rate)
+
+    def transcribe_files(self, files, workers=2, batch_size=None, extensions=(".wav", ".flac", ".mp3", ".ogg", ".m4a")) -> list:
+        """
+        Transcribes a directory or a list of audio files offline.
+        A pool of workers decodes and resamples the next files while the model transcribes the current one,
+        the windows of each file are decoded in batches.
+        Returns one {"path", "text", "chunks", "audio_seconds", "seconds", "real_time_factor"} per file, in order,
+        or {"path", "error"} for a file that could not be transcribed. The timings are also recorded as "stt.file" spans.
+        """
+        if isinstance(files, (str, Path)) and Path(files).is_dir():
+            files = sorted(path for path in Path(files).rglob("*") if path.suffix.lower() in extensions)
+        elif isinstance(files, (str, Path)):
+            files = [files]
+        files, results, workers = list(files), [], max(workers, 1)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stt_decode") as pool:
+            # Only a few files are decoded ahead so a large directory is not held in memory
+            decoded = [pool.submit(self.load_audio, filepath) for filepath in files[:workers]]
+            for index, filepath in enumerate(files):
+                future, decoded[index] = decoded[index], None
+                if index + workers < len(files):
+                    decoded.append(pool.submit(self.load_audio, files[index + workers]))
+                result = {"path": str(filepath)}
+                # One bad file (unsupported format, decoding or inference error) does not stop the others
+                try:
+                    audio = future.result()
+                    audio_seconds = len(audio) / self.sampling_rate
+                    with metrics.span("stt.file", path=str(filepath), audio_seconds=audio_seconds) as span:
+                        start_time = time.time()
+                        inputs = {"raw": audio, "sampling_rate": self.sampling_rate}
+                        output = self.transcribe(inputs, dict(self.default_generate_kwargs, return_timestamps=True), batch_size)
+                        seconds = time.time() - start_time
+                        real_time_factor = seconds / audio_seconds if audio_seconds else 0.0
+                        span.set(real_time_factor=real_time_factor)
+                    result.update({
+                        "text": output["text"],
+                        "chunks": output.get("chunks", []),
+                        "audio_seconds": round(audio_seconds, 3),
+                        "seconds": round(seconds, 3),
+                        "real_time_factor": round(real_time_factor, 4),
+                    })
+                except Exception as e:
+                    result["error"] = f"{type(e).__name__}: {e}"
+                    print(f"[STT] \033[91mCould not transcribe {filepath}: {result['error']}\033[0m")
+                results.append(result)
+        return results
+
 ###DEBUGGING###
 """
-stt = STT_GENERATOR()
+stt = SpeechToTextGenerator()
 stt.generate_text_from_audio()
+stt.transcribe_files("path/to/recordings", workers=4, batch_size=8)
 """
-#To ignore warnings: python -W ignore script.py
\ No newline at end of file
+#To ignore warnings: python -W ignore script.py
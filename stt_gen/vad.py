@@ -0,0 +1,173 @@
+from collections import deque
+import numpy as np
+
+# Events returned by VoiceActivityDetector.process()
+SILENCE = "silence"
+SPEECH_START = "speech_start"
+SPEECH = "speech"
+SPEECH_END = "speech_end"
+
+class VoiceActivityDetector:
+    """
+    Base class for the voice activity detectors used by AudioCapture.
+    Subclasses only decide which frames of a chunk contain speech (speech_frames()), this class runs the
+    endpointing state machine on top of it:
+    - speech starts after start_ms of speech frames,
+    - the last pre_roll_ms of audio before the start is kept so the first syllable is not clipped,
+    - speech ends after end_of_speech_ms without speech frames (or after max_speech_ms, no limit when None),
+    - only hangover_ms of that trailing silence is kept in the recording.
+    """
+    def __init__(self, rate, start_ms=60, end_of_speech_ms=700, hangover_ms=200, pre_roll_ms=300, max_speech_ms=None):
+        self.rate = rate
+        self.start_ms = start_ms
+        self.end_of_speech_ms = end_of_speech_ms
+        self.hangover_ms = hangover_ms
+        self.pre_roll_ms = pre_roll_ms
+        self.max_speech_ms = max_speech_ms
+        self.reset()
+        self.reset_noise_floor()
+
+    def reset(self):
+        """Clears the endpointing state before a new utterance, what the detector learned about the noise is kept."""
+        self.triggered = False
+        self.speech_run_ms = 0.0
+        self.silence_run_ms = 0.0
+        self.speech_ms = 0.0
+        self.pre_roll = deque()
+        self.pre_roll_buffered_ms = 0.0
+        # Trailing silence (ms) that can be dropped from the recording once speech ended
+        self.trim_ms = 0.0
+
+    def reset_noise_floor(self):
+        """Forgets the background noise, for detectors that track it. Only needed when the input changes."""
+        pass
+
+    def speech_frames(self, samples:np.ndarray) -> np.ndarray:
+        """Returns one boolean per frame of the int16 chunk, True for speech."""
+        raise NotImplementedError
+
+    def process(self, chunk) -> str:
+        """Feeds one chunk of int16 PCM and returns SILENCE, SPEECH_START, SPEECH or SPEECH_END."""
+        samples = np.frombuffer(chunk, dtype=np.int16) if isinstance(chunk, (bytes, bytearray)) else chunk
+        flags = self.speech_frames(samples)
+        if len(flags) == 0:
+            return SPEECH if self.triggered else SILENCE
+        frame_ms = 1000.0 * len(samples) / self.rate / len(flags)
+
+        event = None
+        for flag in flags:
+            if not self.triggered:
+                self.speech_run_ms = self.speech_run_ms + frame_ms if flag else 0.0
+                if self.speech_run_ms >= self.start_ms:
+                    self.triggered = True
+                    self.silence_run_ms = 0.0
+                    self.speech_ms = self.speech_run_ms
+                    event = SPEECH_START
+                continue
+            self.speech_ms += frame_ms
+            self.silence_run_ms = 0.0 if flag else self.silence_run_ms + frame_ms
+            if self.silence_run_ms >= self.end_of_speech_ms or (self.max_speech_ms and self.speech_ms >= self.max_speech_ms):
+                self.trim_ms = max(0.0, self.silence_run_ms - self.hangover_ms)
+                self.triggered = False
+                self.speech_run_ms = 0.0
+                return SPEECH_END
+
+        if event is None and not self.triggered:
+            self.add_pre_roll(chunk, 1000.0 * len(samples) / self.rate)
+            return SILENCE
+        return event or SPEECH
+
+    def add_pre_roll(self, chunk, chunk_ms):
+        self.pre_roll.append(chunk)
+        self.pre_roll_buffered_ms += chunk_ms
+        # Keep just enough chunks to cover pre_roll_ms
+        while len(self.pre_roll) > 1 and self.pre_roll_buffered_ms - chunk_ms >= self.pre_roll_ms:
+            self.pre_roll.popleft()
+            self.pre_roll_buffered_ms -= chunk_ms
+
+    def take_pre_roll(self) -> list:
+        """Returns and clears the chunks captured right before speech started."""
+        chunks = list(self.pre_roll)
+        self.pre_roll.clear()
+        self.pre_roll_buffered_ms = 0.0
+        return chunks
+
+class ThresholdVAD(VoiceActivityDetector):
+    """The original detector: a chunk is speech when its mean absolute amplitude is above a fixed threshold."""
+    def __init__(self, rate, threshold=330, **kwargs):
+        self.threshold = threshold
+        super().__init__(rate, **kwargs)
+
+    def speech_frames(self, samples):
+        return np.array([np.abs(samples.astype(np.float32)).mean() >= self.threshold]) if len(samples) else np.zeros(0, dtype=bool)
+
+class AdaptiveVAD(VoiceActivityDetector):
+    """
+    Energy + zero-crossing rate detector with an adaptive noise floor.
+    Features are computed for every frame of a chunk at once with numpy.
+    A frame is speech when its RMS energy is start_ratio times above the noise floor, unless it also has a
+    high zero-crossing rate (hiss, fans) and is not loud enough to be a fricative.
+    The noise floor is the minimum frame energy over the last noise_window_ms, whether the frames were classed
+    as speech or not: it drops immediately on quieter frames, and a steady noise (hum, fan) becomes the floor
+    after noise_window_ms even if it was first taken for speech. The pauses between words keep it at the noise
+    level while the user speaks. initial_noise_rms caps the floor until the first window is filled.
+    reset() keeps the noise floor, so it is only learned once and not again for every utterance.
+    """
+    def __init__(self, rate, frame_ms=20, start_ratio=3.0, min_rms=60.0, zcr_max=0.35,
+                 noise_window_ms=3000, initial_noise_rms=100.0, **kwargs):
+        self.frame_length = max(1, int(rate * frame_ms / 1000))
+        self.start_ratio = start_ratio
+        self.min_rms = min_rms
+        self.zcr_max = zcr_max
+        self.noise_window_frames = max(1, int(noise_window_ms / frame_ms))
+        self.initial_noise_rms = initial_noise_rms
+        super().__init__(rate, **kwargs)
+
+    def reset_noise_floor(self):
+        self.noise_rms = self.initial_noise_rms
+        self.remainder = np.zeros(0, dtype=np.float32)
+        # (frame index, rms) with increasing rms, the first entry is the minimum of the window
+        self.noise_window = deque()
+        self.frame_index = 0
+
+    def frame_features(self, samples):
+        """Returns (rms, zcr) arrays, one value per complete frame. Incomplete frames are kept for the next chunk."""
+        samples = np.concatenate([self.remainder, samples.astype(np.float32)])
+        frame_count = len(samples) // self.frame_length
+        self.remainder = samples[frame_count * self.frame_length:]
+        frames = samples[:frame_count * self.frame_length].reshape(frame_count, self.frame_length)
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        return rms, zcr
+
+    def speech_frames(self, samples):
+        rms, zcr = self.frame_features(samples)
+        flags = np.zeros(len(rms), dtype=bool)
+        for i in range(len(rms)):
+            threshold = max(self.noise_rms * self.start_ratio, self.min_rms)
+            loud = rms[i] >= threshold
+            flags[i] = loud and (zcr[i] <= self.zcr_max or rms[i] >= 2 * threshold)
+            self.update_noise_floor(rms[i])
+        return flags
+
+    def update_noise_floor(self, rms):
+        """Sliding window minimum of the frame energies, amortized O(1) per frame."""
+        window = self.noise_window
+        while window and window[-1][1] >= rms:
+            window.pop()
+        window.append((self.frame_index, rms))
+        if window[0][0] <= self.frame_index - self.noise_window_frames:
+            window.popleft()
+        self.frame_index += 1
+        floor = window[0][1]
+        if self.frame_index < self.noise_window_frames:
+            floor = min(floor, self.initial_noise_rms)
+        self.noise_rms = max(float(floor), 1.0)
+
+def make_vad(kind, rate, **kwargs):
+    if kind == "adaptive":
+        return AdaptiveVAD(rate, **kwargs)
+    if kind == "threshold":
+        return ThresholdVAD(rate, **kwargs)
+    raise ValueError(f"Unknown VAD: {kind}")
@@ -0,0 +1,116 @@
+"""
+Offline evaluation of the voice activity detectors.
+Replays WAV files chunk by chunk through a detector, as AudioCapture would, and reports for each file:
+- endpoint latency: time between the real end of speech and the SPEECH_END event,
+- start/end clipping: speech left out of the recording at the beginning/end.
+The real speech boundaries come from a labels JSON file ({"file.wav": [start_s, end_s]}) when given,
+otherwise they are estimated offline from the whole file energy.
+
+Usage: python -m stt_gen.vad_eval voices/*.wav --vad adaptive --end-ms 700 [--labels labels.json] [--json out.json]
+"""
+import argparse
+import json
+from pathlib import Path
+import numpy as np
+from stt_gen.audio_utils import read_wav, float32_to_pcm16
+from stt_gen.vad import make_vad, SPEECH_START, SPEECH_END
+
+def read_wav_int16(filepath):
+    """Returns (mono int16 samples, rate)."""
+    audio, rate = read_wav(filepath)
+    return float32_to_pcm16(audio), rate
+
+def reference_segment(samples, rate, frame_ms=20):
+    """Estimates (start_s, end_s) of the speech from the energy of the whole file."""
+    frame_length = int(rate * frame_ms / 1000)
+    frame_count = len(samples) // frame_length
+    frames = samples[:frame_count * frame_length].astype(np.float32).reshape(frame_count, frame_length)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    threshold = max(np.percentile(rms, 10) * 4, rms.max() * 0.05)
+    voiced = np.nonzero(rms >= threshold)[0]
+    if len(voiced) == 0:
+        return None
+    return voiced[0] * frame_ms / 1000, (voiced[-1] + 1) * frame_ms / 1000
+
+def replay(vad, samples, rate, chunk=1024):
+    """
+    Feeds the samples to the detector followed by enough silence to let it end the utterance.
+    Returns (captured_start_s, captured_end_s, end_event_s), None values when speech was not detected/ended.
+    """
+    # Every file is a different recording, the noise floor is learned again
+    vad.reset()
+    vad.reset_noise_floor()
+    padding = np.zeros(int(rate * (vad.end_of_speech_ms / 1000 + 1)), dtype=np.int16)
+    samples = np.concatenate([samples, padding])
+    captured_start = captured_end = end_event = None
+    for offset in range(0, len(samples) - chunk + 1, chunk):
+        chunk_end_s = (offset + chunk) / rate
+        event = vad.process(samples[offset:offset + chunk])
+        if event == SPEECH_START and captured_start is None:
+            pre_roll_chunks = len(vad.take_pre_roll())
+            captured_start = offset / rate - pre_roll_chunks * chunk / rate
+        elif event == SPEECH_END and captured_start is not None:
+            end_event = chunk_end_s
+            captured_end = chunk_end_s - vad.trim_ms / 1000
+            break
+    return captured_start, captured_end, end_event
+
+def evaluate_file(filepath, vad_kind="adaptive", labels=None, chunk=1024, **vad_kwargs):
+    samples, rate = read_wav_int16(filepath)
+    reference = (labels or {}).get(Path(filepath).name) or reference_segment(samples, rate)
+    vad = make_vad(vad_kind, rate, **vad_kwargs)
+    captured_start, captured_end, end_event = replay(vad, samples, rate, chunk)
+    result = {"file": str(filepath), "reference": reference, "detected": end_event is not None}
+    if reference is None or end_event is None:
+        return result
+    ref_start, ref_end = reference
+    result.update({
+        "endpoint_latency_ms": round((end_event - ref_end) * 1000, 1),
+        "start_clip_ms": round(max(0.0, captured_start - ref_start) * 1000, 1),
+        "end_clip_ms": round(max(0.0, ref_end - captured_end) * 1000, 1),
+    })
+    return result
+
+def summarize(results) -> dict:
+    detected = [result for result in results if "endpoint_latency_ms" in result]
+    summary = {"files": len(results), "detected": len(detected)}
+    for key in ("endpoint_latency_ms", "start_clip_ms", "end_clip_ms"):
+        values = np.array([result[key] for result in detected])
+        if len(values):
+            summary[key] = {"mean": round(float(values.mean()), 1), "p95": round(float(np.percentile(values, 95)), 1)}
+    summary["clipped_files"] = sum(1 for result in detected if result["start_clip_ms"] > 0 or result["end_clip_ms"] > 0)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay WAV files through a VAD and report endpointing latency and clipping.")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--vad", default="adaptive", choices=["adaptive", "threshold"])
+    parser.add_argument("--end-ms", type=int, default=700, help="End of speech timeout in milliseconds.")
+    parser.add_argument("--hangover-ms", type=int, default=200)
+    parser.add_argument("--pre-roll-ms", type=int, default=300)
+    parser.add_argument("--chunk", type=int, default=1024)
+    parser.add_argument("--labels", help="JSON file mapping file names to [start_s, end_s].")
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    args = parser.parse_args()
+
+    labels = None
+    if args.labels:
+        with open(args.labels, 'r') as file:
+            labels = json.load(file)
+    results = [evaluate_file(filepath, args.vad, labels, args.chunk,
+                             end_of_speech_ms=args.end_ms, hangover_ms=args.hangover_ms, pre_roll_ms=args.pre_roll_ms)
+               for filepath in args.files]
+    for result in results:
+        if result["detected"]:
+            print(f"{result['file']}: latency {result['endpoint_latency_ms']} ms, "
+                  f"start clip {result['start_clip_ms']} ms, end clip {result['end_clip_ms']} ms")
+        else:
+            print(f"{result['file']}: \033[91mno complete utterance detected\033[0m")
+    summary = summarize(results)
+    print(f"\n[VAD_EVAL] {args.vad}: {summary}")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({"vad": args.vad, "results": results, "summary": summary}, file, indent=4)
+
+if __name__ == "__main__":
+    main()
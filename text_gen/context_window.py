@@ -0,0 +1,124 @@
+from threading import Thread, Lock
+
+class ContextWindow():
+    '''
+    Conversation history bounded by a token budget (and optionally a message count).
+    The token length of each message is computed once and cached. When the budget is exceeded
+    the oldest turns are evicted and, if a summarizer is given, folded into a rolling summary message
+    that is produced in a background thread and swapped in at the start of a later turn.
+    '''
+    # Tokens added by the chat template around each message (<|im_start|>role\n ... <|im_end|>\n)
+    message_overhead = 5
+
+    def __init__(self, tokenizer, system_message:dict, max_tokens=2048, max_messages=None, summarize=None):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        # summarize(previous_summary, evicted_messages) -> str
+        self.summarize = summarize
+        self.messages = [system_message]
+        self.token_counts = {}
+        self.summary = ""
+        self.next_summary = None
+        self.evicted = []
+        self.summarizing = False
+        self.lock = Lock()
+
+    def count_tokens(self, message:dict) -> int:
+        key = (message["role"], message["content"])
+        count = self.token_counts.get(key)
+        if count is None:
+            count = len(self.tokenizer(message["content"], add_special_tokens=False).input_ids) + self.message_overhead
+            self.token_counts[key] = count
+        return count
+
+    def total_tokens(self) -> int:
+        return sum(self.count_tokens(message) for message in self.messages)
+
+    def first_turn_index(self) -> int:
+        """Index of the oldest evictable message, after the system prompt and the summary."""
+        return 2 if self.summary else 1
+
+    def append(self, message:dict):
+        self.messages.append(message)
+
+    def discard_last(self, message:dict):
+        """Removes message if it is still the latest one, e.g. a prompt whose reply could not be generated."""
+        if len(self.messages) > 1 and self.messages[-1] is message:
+            self.messages.pop()
+
+    def over_budget(self) -> bool:
+        if self.max_messages is not None and len(self.messages) > self.max_messages:
+            return True
+        return self.max_tokens is not None and self.total_tokens() > self.max_tokens
+
+    def pop_oldest(self) -> dict:
+        message = self.messages.pop(self.first_turn_index())
+        self.token_counts.pop((message["role"], message["content"]), None)
+        return message
+
+    def trim(self) -> list:
+        """
+        Applies a pending summary, then evicts the oldest messages until the window fits the budget.
+        The latest message is always kept. Returns the evicted messages.
+        """
+        self.apply_summary()
+        evicted = []
+        while self.over_budget() and len(self.messages) - self.first_turn_index() > 1:
+            evicted.append(self.pop_oldest())
+        # Don't leave an assistant reply without the user message it answers
+        while evicted and len(self.messages) - self.first_turn_index() > 1 \
+                and self.messages[self.first_turn_index()]["role"] != "user":
+            evicted.append(self.pop_oldest())
+        if evicted and self.summarize is not None:
+            self.start_summary(evicted)
+        return evicted
+
+    def start_summary(self, evicted:list):
+        with self.lock:
+            self.evicted.extend(evicted)
+            if self.summarizing:
+                # The running summary picks up the new messages when it is done
+                return
+            self.summarizing = True
+        Thread(target=self.update_summary, daemon=True).start()
+
+    def update_summary(self):
+        while True:
+            with self.lock:
+                evicted, self.evicted = self.evicted, []
+                previous = self.next_summary if self.next_summary is not None else self.summary
+                if not evicted:
+                    self.summarizing = False
+                    return
+            try:
+                summary = self.summarize(previous, evicted).strip()
+            except Exception as e:
+                print(f"[CONTEXT] \033[91mCould not summarize evicted messages: {e}\033[0m")
+                with self.lock:
+                    self.summarizing = False
+                return
+            with self.lock:
+                self.next_summary = summary
+
+    def apply_summary(self):
+        with self.lock:
+            summary, self.next_summary = self.next_summary, None
+        if not summary:
+            return
+        message = {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+        if self.summary:
+            old = self.messages[1]
+            self.token_counts.pop((old["role"], old["content"]), None)
+            self.messages[1] = message
+        else:
+            self.messages.insert(1, message)
+        self.summary = summary
+
+    def clear(self):
+        """Drops the conversation and its summary, keeping the system message."""
+        with self.lock:
+            self.next_summary = None
+            self.evicted = []
+        del self.messages[1:]
+        self.summary = ""
@@ -0,0 +1,161 @@
+import copy
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
+from threading import Thread, Lock
+from text_gen.context_window import ContextWindow
+from instrumentation import metrics
+import queue, time
+
+class GenerationServer():
+    '''
+    Serves several conversations from the model already loaded by a ResponseGenerator.
+    Each session id has its own history. Prompts queued by different sessions are grouped into one
+    left-padded batch (up to max_batch_size, waiting at most max_wait_ms for the batch to fill)
+    and every caller gets its own reply back through a Future.
+    '''
+    def __init__(self, generator, max_batch_size=4, max_wait_ms=20, context=None, max_context=32, max_context_tokens=2048):
+        self.generator = generator
+        # Own copy: left padding must not leak into the tokenizer used by the generator
+        self.tokenizer = copy.deepcopy(generator.tokenizer)
+        # Left padding keeps the generated tokens aligned at the end of every row
+        self.tokenizer.padding_side = "left"
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.context = context or generator.system_context
+        self.max_context = max_context
+        self.max_context_tokens = max_context_tokens
+        self.sessions = {}
+        self.requests = queue.Queue()
+        # Requests taken from the queue but deferred to a later batch, only used by the worker thread
+        self.pending = deque()
+        self.lock = Lock()
+        self.batches = 0
+        self.batched_requests = 0
+        self.generated_tokens = 0
+        self.generate_seconds = 0.0
+        self.running = True
+        self.worker = Thread(target=self.serve, daemon=True)
+        self.worker.start()
+
+    def session(self, session_id) -> ContextWindow:
+        with self.lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = ContextWindow(
+                    self.tokenizer,
+                    {"role": "system", "content": f"{self.context} Today's date is {datetime.now().date()}"},
+                    max_tokens=self.max_context_tokens,
+                    max_messages=self.max_context,
+                )
+            return self.sessions[session_id]
+
+    def submit(self, session_id, prompt:str, user_name="Jun", save_to_history=False) -> Future:
+        """Queues a prompt and returns a Future resolved with the reply."""
+        future = Future()
+        self.requests.put((session_id, prompt, user_name, save_to_history, future))
+        return future
+
+    def generate_response(self, session_id, prompt:str, user_name="Jun", save_to_history=False, timeout=None) -> str:
+        return self.submit(session_id, prompt, user_name, save_to_history).result(timeout=timeout)
+
+    def next_request(self, timeout):
+        if self.pending:
+            return self.pending.popleft()
+        try:
+            return self.requests.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def next_batch(self) -> list:
+        """Waits for a request, then collects more for up to max_wait_ms. A session appears at most once per batch."""
+        first = self.next_request(timeout=0.1)
+        if first is None:
+            return []
+        batch, deferred = [first], deque()
+        deadline = time.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0 and not self.pending:
+                break
+            request = self.next_request(timeout=max(remaining, 0))
+            if request is None:
+                break
+            if any(request[0] == queued[0] for queued in batch):
+                # The reply to the previous prompt of this session must be in its history first
+                deferred.append(request)
+            else:
+                batch.append(request)
+        # Deferred requests go first next time, in their original order
+        deferred.extend(self.pending)
+        self.pending = deferred
+        return batch
+
+    def serve(self):
+        while self.running:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                self.generate_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request[4].done():
+                        request[4].set_exception(e)
+
+    def generate_batch(self, batch):
+        user_responses = []
+        try:
+            self.generate_batch_replies(batch, user_responses)
+        except Exception:
+            # Without a reply, the prompts would leave two user turns in a row in their sessions
+            for (session_id, *_), user_response in zip(batch, user_responses):
+                self.session(session_id).discard_last(user_response)
+            raise
+
+    def generate_batch_replies(self, batch, user_responses):
+        texts = []
+        for session_id, prompt, user_name, _, _ in batch:
+            window = self.session(session_id)
+            user_response = {"role": "user", "content": f"{user_name}: {prompt}"}
+            window.append(user_response)
+            window.trim()
+            user_responses.append(user_response)
+            texts.append(self.tokenizer.apply_chat_template(window.messages, tokenize=False, add_generation_prompt=True))
+
+        model_inputs = self.tokenizer(texts, return_tensors="pt", padding=True).to(self.generator.device)
+        generate_start_time = time.time()
+        with metrics.span("llm.batch", batch_size=len(batch), padded_prompt_tokens=model_inputs.input_ids.numel()) as span:
+            # Holding the generator keeps its model loaded and not used by another caller meanwhile
+            with self.generator.turn() as model:
+                generated_ids = model.generate(
+                    **model_inputs,
+                    **self.generator.generation_kwargs(),
+                    pad_token_id=self.tokenizer.pad_token_id,
+                )
+            generated_ids = generated_ids[:, model_inputs.input_ids.shape[1]:]
+            generated_tokens = int((generated_ids != self.tokenizer.pad_token_id).sum())
+            span.set(generated_tokens=generated_tokens)
+        self.generate_seconds += time.time() - generate_start_time
+        responses = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+
+        self.batches += 1
+        self.batched_requests += len(batch)
+        self.generated_tokens += generated_tokens
+        for (session_id, _, user_name, save_to_history, future), user_response, response in zip(batch, user_responses, responses):
+            assistant_response = {"role": "assistant", "content": response}
+            self.session(session_id).append(assistant_response)
+            if save_to_history:
+                self.generator.history.append_turn([user_response, assistant_response], session_id=session_id, user_name=user_name)
+            future.set_result(response)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "batches": self.batches,
+            "avg_batch_size": round(self.batched_requests / self.batches, 2) if self.batches else 0.0,
+            "tokens_per_second": round(self.generated_tokens / self.generate_seconds, 2) if self.generate_seconds else 0.0,
+        }
+
+    def close(self):
+        self.running = False
+        self.worker.join()
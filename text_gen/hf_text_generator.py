@@ -1,54 +1,393 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, DynamicCache, StoppingCriteria, StoppingCriteriaList
 from pathlib import Path
 from datetime import datetime
-import time, json
+from threading import Thread, RLock, Lock
+from contextlib import contextmanager
+from text_gen.context_window import ContextWindow
+from text_gen.history_store import HistoryStore
+from cpu_profile import ModelProfile
+from instrumentation import metrics
+from model_residency import ResidentModel
+import time, re
 
-class ResponseGenerator():
+class SentenceSplitter():
+    '''
+    Accumulates streamed text and returns sentences as soon as they are closed.
+    A sentence is closed by . ! ? followed by whitespace, so numbers like 2.5 are not split, or by a new line.
+    The CJK variants close it as soon as the next character arrives, Chinese and Japanese put no space after them.
+    '''
+    sentence_end = re.compile(r'[.!?]+["\')\]]*(?=\s)|[\u3002\uff01\uff1f]+["\')\]\u300d\u300f\uff09]*(?=[^\u3002\uff01\uff1f"\')\]\u300d\u300f\uff09])|\n+')
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text:str) -> list:
+        self.buffer += text
+        sentences = []
+        while True:
+            match = self.sentence_end.search(self.buffer)
+            if match is None:
+                break
+            sentence = self.buffer[:match.end()].strip()
+            self.buffer = self.buffer[match.end():]
+            if sentence:
+                sentences.append(sentence)
+        return sentences
+
+    def flush(self) -> list:
+        sentence = self.buffer.strip()
+        self.buffer = ""
+        return [sentence] if sentence else []
+
+class PrefillTimer():
+    '''
+    Records when the first forward pass of the model ends, which is the forward pass over the prompt (the prefill).
+    It is a forward hook on the main model: with assisted generation the draft model runs its own prefill first,
+    a logits processor would be called by the draft model's generate() and time that one instead.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.start_time = time.time()
+        self.prefill_seconds = None
+        self.handle = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.handle = self.model.register_forward_hook(self.hook)
+        return self
+
+    def __exit__(self, *exc):
+        self.handle.remove()
+
+    def hook(self, module, args, output):
+        if self.prefill_seconds is None:
+            self.prefill_seconds = time.time() - self.start_time
+
+class YieldToTurns(StoppingCriteria):
+    '''Stops a background generation (the rolling summary) as soon as a user turn waits for the model.'''
+    def __init__(self, generator):
+        self.generator = generator
+        self.interrupted = False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+        self.interrupted = self.generator.turns_waiting > 0
+        return torch.full((input_ids.shape[0],), self.interrupted, dtype=torch.bool, device=input_ids.device)
+
+class SpeculationCounter():
+    '''
+    Counts the draft tokens proposed and accepted during assisted generation.
+    generate() builds a candidate generator for every call, install() wraps the model method creating it
+    so that get_candidates() and update_candidate_strategy() of each candidate generator are counted.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.rounds = 0
+        self.proposed = 0
+        self.accepted = 0
+
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    def install(self, model):
+        if not hasattr(model, "_get_candidate_generator"):
+            return
+        get_candidate_generator = model._get_candidate_generator
+
+        def counting_candidate_generator(*args, **kwargs):
+            candidate_generator = get_candidate_generator(*args, **kwargs)
+            get_candidates = candidate_generator.get_candidates
+            update_candidate_strategy = candidate_generator.update_candidate_strategy
+
+            def counting_get_candidates(input_ids, *args, **kwargs):
+                candidates = get_candidates(input_ids, *args, **kwargs)
+                self.rounds += 1
+                self.proposed += candidates[0].shape[-1] - input_ids.shape[-1]
+                return candidates
+
+            def counting_update_candidate_strategy(input_ids, scores, num_matches):
+                self.accepted += int(num_matches)
+                return update_candidate_strategy(input_ids, scores, num_matches)
+
+            candidate_generator.get_candidates = counting_get_candidates
+            candidate_generator.update_candidate_strategy = counting_update_candidate_strategy
+            return candidate_generator
+
+        model._get_candidate_generator = counting_candidate_generator
+
+class ResponseGenerator(ResidentModel):
+    '''
+    Chat model with a bounded conversation window, a reused KV cache and a persistent history.
+    Optional speculative decoding: with draft_model_name a small model of the same family proposes tokens,
+    with prompt_lookup_tokens > 0 candidates are n-grams copied from the prompt. The main model verifies
+    the candidates in one forward pass; with sampling, rejected candidates are resampled from the main model
+    so the replies follow the same distribution as without speculation.
+    '''
     def __init__(self, 
                  model_name="Qwen/Qwen2.5-1.5B-Instruct", 
                  context=f"Your name is Rose. You provide one sentence responses. My name is located before the colon or ':'.",
-                 max_context=32
+                 max_context=32,
+                 use_prefix_cache=True,
+                 max_context_tokens=2048,
+                 summarize_evicted=False,
+                 session_id="default",
+                 history_path="",
+                 load_history_turns=0,
+                 cpu_profile=None,
+                 max_new_tokens=192,
+                 draft_model_name="",
+                 prompt_lookup_tokens=0
                  ):
         self.model_name = model_name
+        # Speculative decoding, a draft model (e.g. "Qwen/Qwen2.5-0.5B-Instruct") or prompt lookup, off by default
+        self.draft_model_name = draft_model_name
+        self.prompt_lookup_tokens = prompt_lookup_tokens
+        self.draft_model = None
+        self.speculation = SpeculationCounter()
+        self.last_acceptance_rate = 0.0
+        # CPU optimizations (quantization, threads...), a no-op profile by default
+        self.cpu_profile = cpu_profile or ModelProfile()
+        # Serializes the uses of the model, which can be offloaded while idle
+        self.lock = RLock()
+        # User turns waiting for the lock, the background summary gives way to them
+        self.turns_waiting = 0
+        self.waiting_lock = Lock()
+        self.prefix_cache = None
+        self.prefix_ids = None
+        with metrics.span("llm.load", model=self.model_name):
+            self.load_weights()
+        self.init_residency(self.lock)
+        self.max_context = max_context
+        self.this_dir = str(Path(__file__).parent.resolve())
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        # System prompt without the date, the GenerationServer sessions add their own
+        self.system_context = context
+        # History bounded by max_context messages and max_context_tokens tokens
+        self.context = ContextWindow(
+            self.tokenizer,
+            {"role": "system", "content": f"{context} Today's date is {datetime.now().date()}"},
+            max_tokens=max_context_tokens,
+            max_messages=max_context,
+            summarize=self.summarize_messages if summarize_evicted else None,
+        )
+        self.messages = self.context.messages
+        self.session_id = session_id
+        self.history = self.open_history(history_path)
+        if load_history_turns:
+            for message in self.history.load_recent_turns(load_history_turns, session_id=self.session_id):
+                self.context.append(message)
+            self.context.trim()
+        # KV cache of the conversation already processed by the model, reused across turns
+        self.use_prefix_cache = use_prefix_cache
+        # Prompt tokens taken from the cache / actually prefilled during the last turn
+        self.last_reused_tokens = 0
+        self.last_prefill_tokens = 0
+        # Timings of the last turn
+        self.max_new_tokens = max_new_tokens
+        self.last_prefill_seconds = 0.0
+        self.last_first_token_seconds = 0.0
+        self.last_generate_seconds = 0.0
+        self.last_generated_tokens = 0
+
+    def load_weights(self):
         self.model = AutoModelForCausalLM.from_pretrained(
             self.model_name,
             torch_dtype="auto",
             device_map="auto"
         )
-        self.max_context = max_context
+        self.model = self.cpu_profile.apply(self.model, self.model.device)
         self.device = self.model.device
-        self.messages = [{"role": "system", "content": f"{context} Today's date is {datetime.now().date()}"}]
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-        self.this_dir = str(Path(__file__).parent.resolve())
+        if self.draft_model_name:
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                self.draft_model_name,
+                torch_dtype="auto",
+                device_map="auto"
+            )
+            self.draft_model = self.cpu_profile.apply(self.draft_model, self.draft_model.device)
+        self.speculation.install(self.model)
 
-    def generate_response(self, prompt:str, user_name="Jun", save_to_history=False):
+    def free_weights(self):
+        # The conversation KV cache is only valid for these weights
+        self.model = None
+        self.draft_model = None
+        self.prefix_cache = None
+        self.prefix_ids = None
+
+    def weight_modules(self) -> list:
+        return [self.model, self.draft_model]
+
+    def speculative_kwargs(self) -> dict:
+        """generate() arguments of the speculative decoding mode, the sampling settings are not changed."""
+        if self.draft_model is not None:
+            return {"assistant_model": self.draft_model}
+        if self.prompt_lookup_tokens:
+            return {"prompt_lookup_num_tokens": self.prompt_lookup_tokens}
+        return {}
+
+    def reset_conversation(self):
+        """Forgets the current conversation (not the stored history), keeping the system message."""
+        self.context.clear()
+        self.prefix_cache = None
+        self.prefix_ids = None
+
+    def open_history(self, history_path=""):
+        if not history_path:
+            history_path = self.this_dir + '/_qwen_text_history.db'
+        history = HistoryStore(history_path)
+        if history.count() == 0:
+            # First start with the SQLite store, import the previous JSON history
+            history.import_json(self.this_dir + '/_qwen_text_history.json', session_id=self.session_id)
+        return history
+
+    def add_user_message(self, prompt:str, user_name="Jun") -> dict:
         user_response = {"role": "user", "content": f"{user_name}: {prompt}"}
-        self.messages.append(user_response)
-        
-        if len(self.messages) > self.max_context:
-            for _ in range(2): self.messages.pop(1)
-        
+        self.context.append(user_response)
+        self.context.trim()
+        return user_response
+
+    def prepare_inputs(self):
         text = self.tokenizer.apply_chat_template(
             self.messages,
             tokenize=False,
             add_generation_prompt=True,
         )
+        return self.tokenizer([text], return_tensors="pt").to(self.device)
+
+    def generation_kwargs(self) -> dict:
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "temperature": 0.5,
+            "repetition_penalty": 1.1,
+        }
+
+    def reuse_prefix_cache(self, input_ids):
+        """
+        Returns the KV cache to pass to generate(), cropped to the longest prefix shared with the new prompt.
+        When old messages are trimmed the prompt diverges right after the system prompt,
+        so the cache is re-anchored on it instead of being thrown away.
+        """
+        prompt_ids = input_ids[0]
+        prefix_len = 0
+        if self.use_prefix_cache and self.prefix_cache is not None and self.prefix_ids is not None:
+            # At least one prompt token must be left for the model to process
+            n = min(len(self.prefix_ids), len(prompt_ids) - 1)
+            mismatch = (self.prefix_ids[:n] != prompt_ids[:n]).nonzero()
+            prefix_len = mismatch[0].item() if len(mismatch) else n
+        if prefix_len == 0:
+            self.prefix_cache = DynamicCache()
+        else:
+            self.prefix_cache.crop(prefix_len)
+        self.last_reused_tokens = prefix_len
+        self.last_prefill_tokens = len(prompt_ids) - prefix_len
+        return self.prefix_cache
+
+    @contextmanager
+    def turn(self):
+        """Holds the model for a user turn, with the weights loaded. A running summary is interrupted."""
+        with self.waiting_lock:
+            self.turns_waiting += 1
+        try:
+            self.lock.acquire()
+        finally:
+            with self.waiting_lock:
+                self.turns_waiting -= 1
+        try:
+            self.ensure_loaded()
+            yield self.model
+        finally:
+            self.lock.release()
+
+    def run_generate(self, model_inputs, **kwargs):
+        """Runs model.generate on the prompt, reusing and then updating the conversation KV cache."""
+        with self.turn():
+            return self.run_generate_locked(model_inputs, **kwargs)
 
+    def run_generate_locked(self, model_inputs, **kwargs):
+        prompt_tokens = model_inputs.input_ids.shape[1]
+        if self.use_prefix_cache:
+            kwargs["past_key_values"] = self.reuse_prefix_cache(model_inputs.input_ids)
+        else:
+            self.last_reused_tokens, self.last_prefill_tokens = 0, prompt_tokens
+        prefill_timer = PrefillTimer(self.model)
+        self.speculation.reset()
+        with metrics.span("llm.generate", prompt_tokens=prompt_tokens, cached_tokens=self.last_reused_tokens,
+                          prefill_tokens=self.last_prefill_tokens) as span:
+            try:
+                with self.cpu_profile.thread_scope(), prefill_timer:
+                    generated_ids = self.model.generate(
+                        **model_inputs,
+                        **self.generation_kwargs(),
+                        **self.speculative_kwargs(),
+                        **kwargs,
+                    )
+            except Exception:
+                self.prefix_cache = None
+                raise
+            self.last_generate_seconds = time.time() - prefill_timer.start_time
+            self.last_prefill_seconds = prefill_timer.prefill_seconds or 0.0
+            self.last_generated_tokens = generated_ids.shape[1] - prompt_tokens
+            span.set(prefill_seconds=self.last_prefill_seconds, generated_tokens=self.last_generated_tokens,
+                     tokens_per_second=self.last_generated_tokens / max(self.last_generate_seconds, 1e-6))
+            if self.speculation.rounds:
+                self.last_acceptance_rate = self.speculation.acceptance_rate()
+                span.set(draft_tokens=self.speculation.proposed, accepted_tokens=self.speculation.accepted,
+                         acceptance_rate=self.last_acceptance_rate)
+        if self.use_prefix_cache:
+            # The cache now holds the prompt and every generated token except the last one
+            self.prefix_ids = generated_ids[0, :self.prefix_cache.get_seq_length()]
+        return generated_ids
+
+    def summarize_messages(self, previous_summary:str, messages:list) -> str:
+        """
+        Folds evicted messages into the rolling summary. Runs in the context window background thread,
+        at low priority: it only takes the model while no turn waits for it, and is interrupted and started
+        again later when a turn arrives, so it never delays a reply by more than one decoding step.
+        """
+        conversation = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        if previous_summary:
+            conversation = f"Previous summary: {previous_summary}\n{conversation}"
+        summary_messages = [
+            {"role": "system", "content": "Summarize the following conversation in at most three sentences. Keep names and facts."},
+            {"role": "user", "content": conversation},
+        ]
+        text = self.tokenizer.apply_chat_template(summary_messages, tokenize=False, add_generation_prompt=True)
         model_inputs = self.tokenizer([text], return_tensors="pt").to(self.device)
+        while True:
+            if self.turns_waiting or not self.lock.acquire(blocking=False):
+                time.sleep(0.05)
+                continue
+            try:
+                self.ensure_loaded()
+                yield_to_turns = YieldToTurns(self)
+                generated_ids = self.model.generate(**model_inputs, max_new_tokens=96, do_sample=False,
+                                                    stopping_criteria=StoppingCriteriaList([yield_to_turns]))
+            finally:
+                self.lock.release()
+            if not yield_to_turns.interrupted:
+                return self.tokenizer.decode(generated_ids[0, model_inputs.input_ids.shape[1]:], skip_special_tokens=True)
+            metrics.record("llm.summary_deferred", 0.0)
+
+    def finish_turn(self, user_response:dict, response:str, save_to_history=False):
+        assistant_response = {"role": "assistant", "content": response}
+        self.messages.append(assistant_response)
+        
+        if save_to_history:
+            user_name = user_response["content"].split(":", 1)[0]
+            self.history.append_turn([user_response, assistant_response], session_id=self.session_id, user_name=user_name)
+
+    def generate_response(self, prompt:str, user_name="Jun", save_to_history=False):
+        user_response = self.add_user_message(prompt, user_name)
+        model_inputs = self.prepare_inputs()
         
         generate_start_time = time.time()
-        generated_ids = self.model.generate(
-            **model_inputs,
-            max_new_tokens=192,
-            temperature=0.5,
-            repetition_penalty = 1.1,
-        )
+        generated_ids = self.run_generate(model_inputs)
         
         generate_end_time = time.time()
         time_elapsed = generate_end_time - generate_start_time
-        print(
-                f"[QWEN] \033[93m{time_elapsed:.2f} seconds.\033[0m"
-            )
+        # Without streaming the first token is only available with the whole reply
+        self.last_first_token_seconds = time_elapsed
         
         #Returns a tensor() object array result
         generated_ids = [
@@ -56,31 +395,68 @@ class ResponseGenerator():
         ]
 
         response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        assistant_response = {"role": "assistant", "content": response}
-        self.messages.append(assistant_response)
-        
-        if save_to_history:
-            self.__update_json_file([user_response, assistant_response])
+        self.finish_turn(user_response, response, save_to_history)
         
         print(f"\n\033[092m {response} \033[0m \n")
         return response
 
-    def __update_json_file(self, new_data, filepath=""):
-        if not filepath:
-            filepath = self.this_dir + '/_qwen_text_history.json'
-        
-        try:
-            with open(filepath, 'r') as file:
-                data = json.load(file)
-        except FileNotFoundError:
-            data = {}
+    def stream_response(self, prompt:str, user_name="Jun", save_to_history=False, on_sentence=None):
+        """
+        Generator yielding decoded text pieces as soon as the model produces them.
+        on_sentence(sentence) is called for every complete sentence, before the rest of the reply is generated.
+        The full reply is added to the history once the stream is exhausted.
+        """
+        user_response = self.add_user_message(prompt, user_name)
+        model_inputs = self.prepare_inputs()
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+
+        def generate():
+            try:
+                self.run_generate(model_inputs, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                # Unblock the consumer
+                streamer.end()
 
-        # Append new data
-        data["messages"].append(new_data)
+        generate_start_time = time.time()
+        first_token_time = None
+        thread = Thread(target=generate, daemon=True)
+        thread.start()
+
+        splitter = SentenceSplitter()
+        pieces = []
+        for piece in streamer:
+            if not piece:
+                continue
+            if first_token_time is None:
+                first_token_time = time.time() - generate_start_time
+            pieces.append(piece)
+            yield piece
+            if on_sentence is not None:
+                for sentence in splitter.feed(piece):
+                    on_sentence(sentence)
+        thread.join()
+        if errors:
+            raise errors[0]
+        if on_sentence is not None:
+            for sentence in splitter.flush():
+                on_sentence(sentence)
+
+        self.last_first_token_seconds = first_token_time or 0.0
+        metrics.record("llm.first_token", self.last_first_token_seconds, prefill_tokens=self.last_prefill_tokens)
+        response = "".join(pieces).strip()
+        self.finish_turn(user_response, response, save_to_history)
+        print(f"\n\033[092m {response} \033[0m \n")
 
-        # Write the updated data back to the file
-        with open(filepath, 'w') as file:
-            json.dump(data, file, indent=4)
+    def stream_sentences(self, prompt:str, user_name="Jun", save_to_history=False):
+        """
+        Generator yielding complete sentences of the reply as soon as they are closed.
+        """
+        splitter = SentenceSplitter()
+        for piece in self.stream_response(prompt, user_name, save_to_history):
+            yield from splitter.feed(piece)
+        yield from splitter.flush()
 
 """
 ###DEBUG###
@@ -0,0 +1,141 @@
+from pathlib import Path
+from threading import Thread, Lock
+import sqlite3, queue, json, time, atexit
+
+class HistoryStore():
+    '''
+    Append-only conversation history stored in SQLite.
+    append_turn() only queues the messages; a background writer inserts them in batches,
+    so saving a turn never rewrites the history and stays off the response path.
+    The queued messages are written on close(), which also runs at interpreter exit.
+    Messages are indexed by session, user and time for fast lookups.
+    '''
+    schema = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            user_name TEXT,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_name, created_at);
+        CREATE INDEX IF NOT EXISTS idx_messages_time ON messages (created_at);
+    """
+
+    def __init__(self, db_path, flush_interval=1.0, batch_size=64):
+        self.db_path = str(db_path)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.read_lock = Lock()
+        connection = self.connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(self.schema)
+        connection.close()
+        # Connection used for lookups, the writer thread opens its own
+        self.reader = self.connect(check_same_thread=False)
+        self.closed = False
+        self.writer = Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def connect(self, check_same_thread=True):
+        return sqlite3.connect(self.db_path, check_same_thread=check_same_thread)
+
+    def append_turn(self, messages:list, session_id="default", user_name=None, created_at=None):
+        """Queues the messages of a turn, returns immediately."""
+        created_at = created_at or time.time()
+        for message in messages:
+            self.queue.put((session_id, user_name, message["role"], message["content"], created_at))
+
+    def write_loop(self):
+        connection = self.connect()
+        while True:
+            rows = []
+            try:
+                rows.append(self.queue.get(timeout=self.flush_interval))
+                while len(rows) < self.batch_size:
+                    rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = None in rows
+            rows = [row for row in rows if row is not None]
+            if rows:
+                try:
+                    with connection:
+                        connection.executemany(
+                            "INSERT INTO messages (session_id, user_name, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                            rows)
+                except sqlite3.Error as e:
+                    print(f"[HISTORY] \033[91mCould not save {len(rows)} messages: {e}\033[0m")
+            for _ in range(len(rows) + stop):
+                self.queue.task_done()
+            if stop:
+                break
+        connection.close()
+
+    def flush(self):
+        """Blocks until every queued message is written."""
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self.writer.join()
+        self.reader.close()
+
+    def query(self, session_id=None, user_name=None, since=None, until=None, limit=None) -> list:
+        """Returns the matching messages in chronological order. since/until are unix timestamps."""
+        conditions, args = [], []
+        if session_id is not None:
+            conditions.append("session_id = ?"); args.append(session_id)
+        if user_name is not None:
+            conditions.append("user_name = ?"); args.append(user_name)
+        if since is not None:
+            conditions.append("created_at >= ?"); args.append(since)
+        if until is not None:
+            conditions.append("created_at < ?"); args.append(until)
+        sql = "SELECT session_id, user_name, role, content, created_at FROM messages"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        # Take the latest rows first so limit keeps the most recent messages
+        sql += " ORDER BY created_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"; args.append(limit)
+        with self.read_lock:
+            rows = self.reader.execute(sql, args).fetchall()
+        keys = ("session_id", "user_name", "role", "content", "created_at")
+        return [dict(zip(keys, row)) for row in reversed(rows)]
+
+    def load_recent_turns(self, turns:int, session_id=None) -> list:
+        """Returns the messages of the last turns as chat messages, ready to extend ResponseGenerator.messages."""
+        rows = self.query(session_id=session_id, limit=turns * 2)
+        # Start on a user message so no reply is loaded without its question
+        while rows and rows[0]["role"] != "user":
+            rows.pop(0)
+        return [{"role": row["role"], "content": row["content"]} for row in rows]
+
+    def count(self) -> int:
+        with self.read_lock:
+            return self.reader.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def import_json(self, filepath, session_id="default"):
+        """Imports the legacy {"messages": [[user, assistant], ...]} history file."""
+        filepath = Path(filepath)
+        if not filepath.exists():
+            return 0
+        with open(filepath, 'r') as file:
+            data = json.load(file)
+        turns = data.get("messages", [])
+        # The legacy file has no timestamps, keep the original order
+        start = time.time() - len(turns)
+        for i, turn in enumerate(turns):
+            user_name = turn[0]["content"].split(":", 1)[0] if turn and ":" in turn[0]["content"] else None
+            self.append_turn(turn, session_id=session_id, user_name=user_name, created_at=start + i)
+        self.flush()
+        return len(turns)
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from pathlib import Path
+import numpy as np
+
+class AudioCache:
+    """
+    Content-addressed cache of synthesized replies.
+    The key is a hash of the normalized text, voice, language and sampling parameters, the value the int16 PCM
+    stored in <key>.pcm. The index (key, size, last use, hits) is a fixed capacity numpy memmap, so opening
+    the cache only maps one small file, and the total size is bounded with LRU eviction.
+    """
+    index_dtype = np.dtype([("key", "S32"), ("nbytes", "<i8"), ("last_used", "<f8"), ("hits", "<i8")])
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, capacity=4096):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        index_path = self.cache_dir / "index.bin"
+        if index_path.exists() and index_path.stat().st_size == capacity * self.index_dtype.itemsize:
+            self.index = np.memmap(index_path, dtype=self.index_dtype, mode="r+", shape=(capacity,))
+        else:
+            self.index = np.memmap(index_path, dtype=self.index_dtype, mode="w+", shape=(capacity,))
+        self.slots = {entry["key"].decode(): slot for slot, entry in enumerate(self.index) if entry["key"]}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def normalize_text(text:str) -> str:
+        """Case, spacing and quote style don't change the synthesized audio."""
+        text = text.replace("’", "'").replace("“", '"').replace("”", '"')
+        return re.sub(r"\s+", " ", text).strip().lower()
+
+    def make_key(self, text, voice, language, params:dict) -> str:
+        payload = json.dumps([self.normalize_text(text), voice, language, params], sort_keys=True)
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+    def audio_path(self, key) -> Path:
+        return self.cache_dir / f"{key}.pcm"
+
+    def get(self, key):
+        """Returns the cached float32 waveform or None."""
+        with self.lock:
+            slot = self.slots.get(key)
+            path = self.audio_path(key)
+            if slot is None or not path.exists():
+                self.misses += 1
+                return None
+            self.index[slot]["last_used"] = time.time()
+            self.index[slot]["hits"] += 1
+            nbytes = int(self.index[slot]["nbytes"])
+            self.hits += 1
+            self.bytes_saved += nbytes
+        if nbytes == 0:
+            return np.zeros(0, dtype=np.float32)
+        pcm = np.memmap(path, dtype=np.int16, mode="r")
+        return pcm.astype(np.float32) / 32768.0
+
+    def put(self, key, wav):
+        pcm = (np.clip(np.asarray(wav, dtype=np.float32), -1.0, 1.0) * 32767).astype(np.int16)
+        with self.lock:
+            if key in self.slots:
+                return
+            self.evict(pcm.nbytes)
+            slot = self.free_slot()
+            pcm.tofile(self.audio_path(key))
+            self.index[slot] = (key.encode(), pcm.nbytes, time.time(), 0)
+            self.slots[key] = slot
+            self.index.flush()
+
+    def total_bytes(self) -> int:
+        return int(self.index["nbytes"].sum())
+
+    def free_slot(self) -> int:
+        empty = np.nonzero(self.index["key"] == b"")[0]
+        if len(empty):
+            return int(empty[0])
+        return self.evict_slot(self.lru_slot())
+
+    def lru_slot(self) -> int:
+        used = np.nonzero(self.index["key"] != b"")[0]
+        return int(used[np.argmin(self.index["last_used"][used])])
+
+    def evict_slot(self, slot) -> int:
+        key = self.index[slot]["key"].decode()
+        self.audio_path(key).unlink(missing_ok=True)
+        self.slots.pop(key, None)
+        self.index[slot] = (b"", 0, 0.0, 0)
+        return slot
+
+    def evict(self, incoming_bytes):
+        """Evicts the least recently used entries until incoming_bytes fit in max_bytes."""
+        while self.slots and self.total_bytes() + incoming_bytes > self.max_bytes:
+            self.evict_slot(self.lru_slot())
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.slots),
+            "total_bytes": self.total_bytes(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
@@ -0,0 +1,183 @@
+import threading
+import wave
+import numpy as np
+
+class RingBuffer:
+    """
+    Fixed size float32 ring buffer shared by a producer (the synthesizer) and a consumer (the audio callback).
+    write() blocks while the buffer is full, read() never blocks and pads missing samples with silence.
+    """
+    def __init__(self, capacity):
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.read_pos = 0
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def write(self, samples, timeout=None):
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1)
+        offset = 0
+        with self.condition:
+            while offset < len(samples):
+                if self.size == self.capacity:
+                    if not self.condition.wait(timeout=timeout):
+                        raise TimeoutError("Audio ring buffer is full.")
+                    continue
+                write_pos = (self.read_pos + self.size) % self.capacity
+                count = min(len(samples) - offset, self.capacity - self.size, self.capacity - write_pos)
+                self.buffer[write_pos:write_pos + count] = samples[offset:offset + count]
+                self.size += count
+                offset += count
+
+    def read(self, count):
+        """Returns (samples, available) where samples always has count entries."""
+        out = np.zeros(count, dtype=np.float32)
+        with self.condition:
+            available = min(count, self.size)
+            first = min(available, self.capacity - self.read_pos)
+            out[:first] = self.buffer[self.read_pos:self.read_pos + first]
+            out[first:available] = self.buffer[:available - first]
+            self.read_pos = (self.read_pos + available) % self.capacity
+            self.size -= available
+            self.condition.notify_all()
+        return out, available
+
+    def clear(self):
+        with self.condition:
+            self.read_pos = 0
+            self.size = 0
+            self.condition.notify_all()
+
+class AudioSink:
+    """
+    Interface for everything that consumes synthesized float32 audio.
+    write() pushes a chunk, finish() marks the end of an utterance and wait() blocks until it was fully played.
+    """
+    def __init__(self, sample_rate=24000):
+        self.sample_rate = sample_rate
+        self.done = threading.Event()
+        self.done.set()
+
+    def write(self, chunk):
+        raise NotImplementedError
+
+    def finish(self):
+        self.done.set()
+
+    def wait(self, timeout=None) -> bool:
+        return self.done.wait(timeout=timeout)
+
+    def play(self, wav):
+        """Plays a whole waveform and blocks until it is done."""
+        self.write(wav)
+        self.finish()
+        self.wait()
+
+    def close(self):
+        pass
+
+class NullSink(AudioSink):
+    """Discards the audio, only counts the samples. Useful for tests and benchmarks."""
+    def __init__(self, sample_rate=24000):
+        super().__init__(sample_rate)
+        self.samples_written = 0
+
+    def write(self, chunk):
+        self.done.clear()
+        self.samples_written += len(np.asarray(chunk).reshape(-1))
+
+class WavFileSink(AudioSink):
+    """Collects the chunks of an utterance and writes them in a WAV file on finish()."""
+    def __init__(self, filepath, sample_rate=24000):
+        super().__init__(sample_rate)
+        self.filepath = str(filepath)
+        self.chunks = []
+
+    def write(self, chunk):
+        self.done.clear()
+        self.chunks.append(np.asarray(chunk, dtype=np.float32).reshape(-1))
+
+    def finish(self):
+        audio = np.concatenate(self.chunks) if self.chunks else np.zeros(0, dtype=np.float32)
+        pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+        wf = wave.open(self.filepath, 'wb')
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(self.sample_rate)
+        wf.writeframes(pcm.tobytes())
+        wf.close()
+        self.chunks = []
+        super().finish()
+
+class PyAudioSink(AudioSink):
+    """
+    Low latency output through a PyAudio callback stream reading from a ring buffer.
+    The stream stays open between utterances, so playback starts as soon as the first chunk is written.
+    Completion is signalled with an event once the utterance is finished and the buffer drained.
+    """
+    def __init__(self, sample_rate=24000, device_name="", buffer_seconds=30, frames_per_buffer=512):
+        super().__init__(sample_rate)
+        import pyaudio
+        self.pyaudio = pyaudio
+        self.audio = pyaudio.PyAudio()
+        self.ring = RingBuffer(int(sample_rate * buffer_seconds))
+        self.finished = True
+        self.underruns = 0
+        self.stream = self.audio.open(format=pyaudio.paFloat32,
+                                      channels=1,
+                                      rate=sample_rate,
+                                      output=True,
+                                      output_device_index=self.find_output_device_index(device_name),
+                                      frames_per_buffer=frames_per_buffer,
+                                      stream_callback=self.callback)
+        self.stream.start_stream()
+
+    def find_output_device_index(self, device_name):
+        """Find the index of the output device by name, None selects the default device."""
+        if not device_name:
+            return None
+        for i in range(self.audio.get_device_count()):
+            dev_info = self.audio.get_device_info_by_index(i)
+            if dev_info["name"] == device_name and dev_info["maxOutputChannels"] > 0:
+                return i
+        print(f"[AudioSink] Output device '{device_name}' not found, using the default device.")
+        return None
+
+    def callback(self, in_data, frame_count, time_info, status):
+        samples, available = self.ring.read(frame_count)
+        if available < frame_count:
+            if self.finished and self.ring.size == 0:
+                self.done.set()
+            elif not self.done.is_set():
+                # The synthesizer did not keep up with playback
+                self.underruns += 1
+        return (samples.tobytes(), self.pyaudio.paContinue)
+
+    def write(self, chunk):
+        self.finished = False
+        self.done.clear()
+        self.ring.write(chunk)
+
+    def finish(self):
+        # The callback sets done once the remaining samples were played
+        self.finished = True
+
+    def stop(self):
+        """Interrupts the current utterance."""
+        self.ring.clear()
+        self.finish()
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.audio.terminate()
+        self.done.set()
+
+def make_sink(kind="pyaudio", sample_rate=24000, device_name="", filepath=""):
+    if kind == "pyaudio":
+        return PyAudioSink(sample_rate=sample_rate, device_name=device_name)
+    if kind == "file":
+        return WavFileSink(filepath, sample_rate=sample_rate)
+    if kind == "null":
+        return NullSink(sample_rate=sample_rate)
+    raise ValueError(f"Unknown audio sink: {kind}")
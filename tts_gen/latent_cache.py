@@ -0,0 +1,97 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import torch
+
+class SpeakerLatentCache:
+    """
+    Cache of XTTS speaker conditioning latents (gpt_cond_latent, speaker_embedding).
+    Entries are keyed by the content hash of the reference voice file plus the conditioning settings,
+    kept in memory with LRU eviction and stored on disk as .pt files so restarts don't recompute them.
+    Editing a voice file changes its hash, which invalidates its entries automatically.
+    """
+    def __init__(self, cache_dir, max_entries=8, device="cpu"):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.device = device
+        self.entries = OrderedDict()
+        # path -> (mtime_ns, size, sha1), so unchanged files are not re-hashed
+        self.file_hashes = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def file_hash(self, path:Path) -> str:
+        stat = path.stat()
+        cached = self.file_hashes.get(str(path))
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha1.update(block)
+        digest = sha1.hexdigest()
+        if cached is not None and cached[2] != digest:
+            self.invalidate(cached[2])
+        self.file_hashes[str(path)] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def make_key(self, path:Path, gpt_cond_len, max_ref_len, sound_norm_refs) -> str:
+        return f"{self.file_hash(path)}_{gpt_cond_len}_{max_ref_len}_{int(bool(sound_norm_refs))}"
+
+    def invalidate(self, file_digest:str):
+        """Drops the memory and disk entries computed from an older version of a voice file."""
+        for key in [key for key in self.entries if key.startswith(file_digest)]:
+            del self.entries[key]
+        for cache_file in self.cache_dir.glob(f"{file_digest}_*.pt"):
+            cache_file.unlink(missing_ok=True)
+
+    def get(self, audio_path, compute, gpt_cond_len, max_ref_len, sound_norm_refs):
+        """
+        Returns (gpt_cond_latent, speaker_embedding) for the voice file.
+        compute() is only called on a memory and disk miss. It runs without the cache lock held,
+        since it takes the model lock, which synthesis holds while reading the cache.
+        """
+        path = Path(audio_path)
+        with self.lock:
+            key = self.make_key(path, gpt_cond_len, max_ref_len, sound_norm_refs)
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        cache_file = self.cache_dir / f"{key}.pt"
+        if cache_file.exists():
+            data = torch.load(cache_file, map_location=self.device)
+            latents, computed = (data["gpt_cond_latent"], data["speaker_embedding"]), False
+        else:
+            latents, computed = compute(), True
+
+        with self.lock:
+            if key in self.entries:
+                # Another thread filled the entry in the meantime, keep a single copy
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            if computed:
+                self.misses += 1
+                torch.save({"gpt_cond_latent": latents[0].cpu(),
+                            "speaker_embedding": latents[1].cpu()}, cache_file)
+            else:
+                self.disk_hits += 1
+            self.entries[key] = latents
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return latents
+
+    def clear(self, disk=False):
+        with self.lock:
+            self.entries.clear()
+            if disk:
+                for cache_file in self.cache_dir.glob("*.pt"):
+                    cache_file.unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
@@ -0,0 +1,80 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+class TTSBatchServer:
+    """
+    Lets several sessions share one TextToSpeechGenerator.
+    Requests submitted concurrently are collected for up to max_wait_ms (max_batch_size at most)
+    and synthesized together with synthesize_batch(), every caller gets its waveform through a Future.
+    """
+    def __init__(self, tts, max_batch_size=8, max_wait_ms=30):
+        self.tts = tts
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batched_requests = 0
+        self.running = True
+        self.worker = threading.Thread(target=self.serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, text, voice=None, language=None) -> Future:
+        future = Future()
+        self.requests.put(((text, voice, language), future))
+        return future
+
+    def synthesize(self, text, voice=None, language=None, timeout=None):
+        return self.submit(text, voice, language).result(timeout=timeout)
+
+    def prerender(self, phrases, voice=None, language=None) -> dict:
+        """Synthesizes a list of prompts in one batch, returns {phrase: waveform}."""
+        wavs = self.tts.synthesize_batch([(phrase, voice, language) for phrase in phrases])
+        return dict(zip(phrases, wavs))
+
+    def next_batch(self) -> list:
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def serve(self):
+        while self.running:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                wavs = self.tts.synthesize_batch([request for request, _ in batch], return_exceptions=True)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.batched_requests += len(batch)
+            for (_, future), wav in zip(batch, wavs):
+                # A failed request only fails its own caller
+                if isinstance(wav, Exception):
+                    future.set_exception(wav)
+                else:
+                    future.set_result(wav)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "avg_batch_size": round(self.batched_requests / self.batches, 2) if self.batches else 0.0,
+        }
+
+    def close(self):
+        self.running = False
+        self.worker.join()
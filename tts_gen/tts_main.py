@@ -1,24 +1,63 @@
 import json
 import time
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 import torch
+import torch.nn.functional as F
 import torchaudio
+import numpy as np
 from TTS.tts.configs.xtts_config import XttsConfig
 from TTS.tts.models.xtts import Xtts
-from pygame import mixer
+from TTS.tts.layers.xtts.tokenizer import split_sentence
+from tts_gen.latent_cache import SpeakerLatentCache
+from tts_gen.audio_sink import make_sink
+from tts_gen.audio_cache import AudioCache
+from cpu_profile import ModelProfile
+from instrumentation import metrics
+from model_residency import ResidentModel
 
 #MAIN CLASS FOR GENERATING SPEECH
-class TextToSpeechGenerator:
+class TextToSpeechGenerator(ResidentModel):
     """
     Base class for producing audio response from text.
+    The XTTS weights can be offloaded while idle, they are loaded again on the next synthesis.
+    With low_vram on a GPU, the model waits in system RAM and is only moved to the GPU while synthesizing.
     """
-    def __init__(self):
+    def __init__(self, sink=None, cpu_profile=None):
         self.this_dir = Path(__file__).parent.resolve()
         self.params = self.load_config(self.this_dir / "config" / "tts_config.json")
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.xtts_model_path = "xtts_model"
-        mixer.init(devicename=self.params["device_output"])
-        self.params["low_vram"] = "false" if not torch.cuda.is_available() else self.params["low_vram"]
+        # XTTSv2 outputs 24 kHz mono audio
+        self.sample_rate = 24000
+        # Where the synthesized audio goes, a PyAudio output stream by default
+        self.sink = sink if sink is not None else make_sink(self.params.get("audio_sink", "pyaudio"),
+                                                            sample_rate=self.sample_rate,
+                                                            device_name=self.params["device_output"])
+        self.low_vram = str(self.params.get("low_vram", False)).lower() == "true"
+        # Seconds of inactivity before the residency manager frees the weights, used in low VRAM mode on CPU
+        self.idle_ttl = float(self.params.get("low_vram_idle_s", 60)) if self.low_vram and self.device == "cpu" else 0
+        self.latent_cache = SpeakerLatentCache(self.this_dir / "latent_cache",
+                                               max_entries=int(self.params.get("latent_cache_size", 8)),
+                                               device=self.device)
+        # Synthesized replies, reused when the same text is said again with the same voice and settings
+        self.audio_cache = None
+        if self.params.get("audio_cache", True):
+            self.audio_cache = AudioCache(self.this_dir / "audio_cache",
+                                          max_bytes=int(self.params.get("audio_cache_max_mb", 200)) * 1024 * 1024)
+        # CPU optimizations of the XTTS GPT (quantization, threads...), a no-op profile by default
+        self.cpu_profile = cpu_profile or ModelProfile()
+        # XTTS keeps per-call state in its GPT, only one synthesis can run at a time
+        self.model_lock = threading.RLock()
+        self.model_users = 0
+        self.lock_wait = 0.0
+        self.xtts_model = None
+        self.model_device = self.device
+        # Timings of the last synthesis, audio_seconds is the duration of the produced audio
+        self.last_first_chunk_seconds = 0.0
+        self.last_generate_seconds = 0.0
+        self.last_audio_seconds = 0.0
         self.setup()
 
     def load_config(self, file_path):
@@ -27,97 +66,432 @@ class TextToSpeechGenerator:
         return configfile_data
 
     def setup(self):
-        # Set a timer to calculate load times
-        generate_start_time = time.time() 
-
         # Start loading the correct model as set by "tts_method_xtts_local"
         print(f"\033[94mCoqui-tts XTTSv2 Local Loading\033[0m {self.xtts_model_path} \033[94minto\033[93m {self.device}\033[0m")
-        self.xtts_load_model()
-
-        # Create an end timer for calculating load times
-        generate_end_time = time.time()
-        generate_elapsed_time = generate_end_time - generate_start_time
-        print(f"\033[94mCoqui-tts Model Loaded in \033[93m{generate_elapsed_time:.2f} seconds.\033[0m")
+        with metrics.span("tts.load", model=self.xtts_model_path, device=self.device):
+            # The config is small and kept when the weights are offloaded
+            self.xtts_config = XttsConfig()
+            self.xtts_config.load_json(str(self.this_dir / self.xtts_model_path / "config.json"))
+            self.xtts_load_model()
+        self.init_residency(self.model_lock)
 
     def xtts_load_model(self):
-        global xtts_model
-        config = XttsConfig()
-        config_path = self.this_dir / self.xtts_model_path / "config.json"
         vocab_path_dir = self.this_dir / self.xtts_model_path / "vocab.json"
         checkpoint_dir = self.this_dir / self.xtts_model_path
 
-        config.load_json(str(config_path))
-        xtts_model = Xtts.init_from_config(config)
+        xtts_model = Xtts.init_from_config(self.xtts_config)
         xtts_model.load_checkpoint(
-            config,
+            self.xtts_config,
             checkpoint_dir=str(checkpoint_dir),
             vocab_path=str(vocab_path_dir),
             #use_deepspeed=self.params["deepspeed_activate"],
         )
-        xtts_model.to(self.device)
+        # In low VRAM mode the model waits in system RAM between syntheses
+        self.model_device = "cpu" if self.low_vram else self.device
+        xtts_model.to(self.model_device)
+        # Optimized for the device it runs on, not the one it waits on
+        xtts_model.gpt = self.cpu_profile.apply(xtts_model.gpt, self.device)
+        self.xtts_model = xtts_model
+
+    # RESIDENCY, SEE model_residency.ResidentModel
+    def load_weights(self):
+        self.xtts_load_model()
+
+    def free_weights(self):
+        self.xtts_model = None
+
+    def weight_modules(self) -> list:
+        return [self.xtts_model]
 
     def unload_model(self):
         print(f"[{self.params['branding']}Model] \033[94mUnloading model \033[0m")
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        return None
+        self.offload()
 
     # LOW VRAM - MODEL MOVER VRAM(cuda)<>System RAM(cpu) for Low VRAM setting
-    def change_device(self):
-        # Check if CUDA is available before performing GPU-related operations
-        if torch.cuda.is_available():
-            if device == "cuda":
-                device = "cpu"
-                xtts_model.to(self.device)
-                torch.cuda.empty_cache()
-            else:
-                device = "cuda"
-                xtts_model.to(self.device)
+    def change_device(self, device):
+        if self.xtts_model is None or device == self.model_device:
+            return
+        if device == "cuda" and not torch.cuda.is_available():
+            return
+        self.xtts_model.to(device)
+        self.model_device = device
+        if device == "cpu" and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    # HOLD THE MODEL LOCK WITH THE WEIGHTS LOADED, AND ON THE GPU IN LOW VRAM MODE
+    @contextmanager
+    def use_model(self):
+        wait_start_time = time.time()
+        with self.model_lock, self.cpu_profile.thread_scope():
+            self.lock_wait = time.time() - wait_start_time
+            self.ensure_loaded()
+            self.model_users += 1
+            try:
+                if self.low_vram:
+                    self.change_device(self.device)
+                yield self.xtts_model
+            finally:
+                self.model_users -= 1
+                # Only the outermost user gives the VRAM back
+                if self.low_vram and self.model_users == 0:
+                    self.change_device("cpu")
+
+    # SPEAKER CONDITIONING LATENTS, CACHED PER VOICE FILE
+    def get_speaker_latents(self, voice):
+        audio_path = self.this_dir / "voices" / voice
+
+        def compute_latents():
+            with self.use_model() as xtts_model:
+                return xtts_model.get_conditioning_latents(
+                    audio_path=[str(audio_path)],
+                    gpt_cond_len=self.xtts_config.gpt_cond_len,
+                    max_ref_length=self.xtts_config.max_ref_len,
+                    sound_norm_refs=self.xtts_config.sound_norm_refs,
+                )
+
+        return self.latent_cache.get(
+            audio_path,
+            compute_latents,
+            gpt_cond_len=self.xtts_config.gpt_cond_len,
+            max_ref_len=self.xtts_config.max_ref_len,
+            sound_norm_refs=self.xtts_config.sound_norm_refs,
+        )
+
+    # COMPUTE THE LATENTS OF EVERY VOICE UP FRONT SO SWITCHING VOICES/EMOTIONS IS CHEAP
+    def preload_voices(self, voices=None):
+        if voices is None:
+            voices = sorted(path.name for path in (self.this_dir / "voices").glob("*.wav"))
+        for voice in voices:
+            self.get_speaker_latents(voice)
+
+    # SAMPLING SETTINGS, ALSO PART OF THE AUDIO CACHE KEY
+    def sampling_params(self) -> dict:
+        params = {
+            "temperature": float(self.params["local_temperature"]),
+            "speed": float(self.params["local_speed"]),
+            "repetition_penalty": float(self.params["local_repetition_penalty"]),
+            "length_penalty": float(self.xtts_config.length_penalty),
+            "top_k": int(self.xtts_config.top_k),
+            "top_p": float(self.xtts_config.top_p),
+        }
+        if self.params.get("deterministic", False):
+            params["seed"] = int(self.params.get("seed", 0))
+        return params
+
+    # IN DETERMINISTIC MODE A REQUEST SYNTHESIZED AGAIN THROUGH THE SAME PATH GIVES THE SAME AUDIO.
+    # THE AUDIO CACHE IS SHARED BY synthesize, stream_audio AND synthesize_batch, WHICH DO NOT PRODUCE
+    # IDENTICAL SAMPLES (STREAMED INFERENCE, PADDED BATCH DECODING): A HIT IS A RENDERING OF THE SAME TEXT,
+    # VOICE AND SETTINGS, NOT NECESSARILY THE ONE THE CURRENT PATH WOULD HAVE GENERATED
+    def seed_generation(self):
+        if self.params.get("deterministic", False):
+            torch.manual_seed(int(self.params.get("seed", 0)))
+
+    # BENCHMARKS DISABLE THE CACHE, REPEATED TURNS WOULD OTHERWISE ONLY MEASURE CACHE HITS
+    def disable_audio_cache(self):
+        self.audio_cache = None
+
+    # LOOK UP A SYNTHESIZED REPLY, RETURNS (key, waveform or None)
+    def cached_audio(self, text, voice, language):
+        if self.audio_cache is None:
+            return None, None
+        key = self.audio_cache.make_key(text, voice, language, self.sampling_params())
+        return key, self.audio_cache.get(key)
+
+    def cache_audio(self, key, wav):
+        if self.audio_cache is not None and key is not None:
+            self.audio_cache.put(key, wav)
+
+    # PRE-RENDER A PHRASE LIST (list of strings or a text file with one phrase per line)
+    def prewarm(self, phrases, voice=None, language=None) -> dict:
+        if isinstance(phrases, (str, Path)):
+            with open(phrases, "r", encoding="utf-8") as phrase_file:
+                phrases = [line.strip() for line in phrase_file if line.strip()]
+        self.synthesize_batch([(phrase, voice, language) for phrase in phrases])
+        return self.audio_cache.stats() if self.audio_cache is not None else {}
 
     # PLAY GENERATED AUDIO
     def play_audio(self, output_file):
-        mixer.music.load(output_file)
-        mixer.music.play()
-        while mixer.music.get_busy():  # wait for sound file to finish playing
-            time.sleep(1)
-        mixer.music.unload()
+        # torchaudio handles the float32 WAV files written by generate_audio
+        wav, sample_rate = torchaudio.load(str(output_file))
+        wav = wav.mean(dim=0)
+        if sample_rate != self.sample_rate:
+            wav = torchaudio.functional.resample(wav, sample_rate, self.sample_rate)
+        self.play_wav(wav.numpy())
 
-    # TTS VOICE GENERATION METHOD
-    def generate_audio(self, text, voice=None, language=None, output_file_path=""):
+    # PLAY A WAVEFORM FROM MEMORY
+    def play_wav(self, wav):
+        # Returns as soon as the sink signals the end of playback, no polling
+        self.sink.play(np.asarray(wav, dtype=np.float32))
+
+    # STREAM SYNTHESIZED CHUNKS TO THE SINK AS SOON AS THEY ARE GENERATED
+    def stream_audio(self, text, voice=None, language=None, sink=None, wait=True, use_cache=True):
         if voice == None: voice = self.params["voice"]
         if language == None: language = self.params["language"]
-        if output_file_path == "": 
-            output_file_path = str(self.this_dir) + self.params["output_folder_wav"] + "response.wav" 
-        
+        if sink is None: sink = self.sink
+
+        generate_start_time = time.time()
+        first_chunk_time = None
+        key, wav = self.cached_audio(text, voice, language) if use_cache else (None, None)
+        if wav is not None:
+            # Cache hit, nothing to synthesize
+            lookup_seconds = time.time() - generate_start_time
+            self.record_synthesis("tts.cache_hit", lookup_seconds, lookup_seconds, wav)
+            sink.write(wav)
+            sink.finish()
+            if wait:
+                sink.wait()
+            return wav
+        wav_chunks = []
+        try:
+            with self.use_model() as xtts_model:
+                lock_wait = self.lock_wait
+                gpt_cond_latent, speaker_embedding = self.get_speaker_latents(voice)
+                chunks = xtts_model.inference_stream(
+                    text,
+                    language,
+                    gpt_cond_latent=gpt_cond_latent,
+                    speaker_embedding=speaker_embedding,
+                    stream_chunk_size=int(self.params.get("stream_chunk_size", 20)),
+                    temperature=float(self.params["local_temperature"]),
+                    speed=float(self.params["local_speed"]),
+                    length_penalty=float(self.xtts_config.length_penalty),
+                    repetition_penalty=float(self.params["local_repetition_penalty"]),
+                    top_k=int(self.xtts_config.top_k),
+                    top_p=float(self.xtts_config.top_p),
+                    enable_text_splitting=True,
+                )
+                self.seed_generation()
+                for chunk in chunks:
+                    chunk = chunk.squeeze().cpu().numpy().astype(np.float32)
+                    if first_chunk_time is None:
+                        first_chunk_time = time.time() - generate_start_time
+                    sink.write(chunk)
+                    wav_chunks.append(chunk)
+        finally:
+            # Also on failure, the sink would otherwise wait for more audio and count underruns until the next utterance
+            sink.finish()
+
+        generate_elapsed_time = time.time() - generate_start_time
+        wav = np.concatenate(wav_chunks) if wav_chunks else np.zeros(0, dtype=np.float32)
+        self.record_synthesis("tts.stream", first_chunk_time or generate_elapsed_time, generate_elapsed_time, wav,
+                              lock_wait_seconds=lock_wait)
+        self.cache_audio(key, wav)
+        if wait:
+            sink.wait()
+        return wav
+
+    # SYNTHESIZE TEXT INTO A FLOAT32 WAVEFORM WITHOUT PLAYING IT
+    def synthesize(self, text, voice=None, language=None, use_cache=True):
+        if voice == None: voice = self.params["voice"]
+        if language == None: language = self.params["language"]
+
+        key = None
+        if use_cache:
+            key, wav = self.cached_audio(text, voice, language)
+            if wav is not None:
+                return wav
+
         generate_start_time = time.time()  # Record the start time of generating TTS
 
         # XTTSv2 LOCAL Method Default
-        gpt_cond_latent, speaker_embedding = xtts_model.get_conditioning_latents(
-            audio_path=[f"{self.this_dir}/voices/{voice}"],
-            gpt_cond_len=xtts_model.config.gpt_cond_len,
-            max_ref_length=xtts_model.config.max_ref_len,
-            sound_norm_refs=xtts_model.config.sound_norm_refs,
-        )
-
-        out = xtts_model.inference(
-            text,
-            language,
-            gpt_cond_latent=gpt_cond_latent,
-            speaker_embedding=speaker_embedding,
-            temperature=float(self.params["local_temperature"]),
-            speed=float(self.params["local_speed"]),
-            length_penalty=float(xtts_model.config.length_penalty),
-            repetition_penalty=float(self.params["local_repetition_penalty"]),
-            top_k=int(xtts_model.config.top_k),
-            top_p=float(xtts_model.config.top_p),
-            enable_text_splitting=True,
-        )
-        torchaudio.save(output_file_path, torch.tensor(out["wav"]).unsqueeze(0), 24000)
+        with self.use_model() as xtts_model:
+            lock_wait = self.lock_wait
+            gpt_cond_latent, speaker_embedding = self.get_speaker_latents(voice)
+            self.seed_generation()
+            out = xtts_model.inference(
+                text,
+                language,
+                gpt_cond_latent=gpt_cond_latent,
+                speaker_embedding=speaker_embedding,
+                temperature=float(self.params["local_temperature"]),
+                speed=float(self.params["local_speed"]),
+                length_penalty=float(self.xtts_config.length_penalty),
+                repetition_penalty=float(self.params["local_repetition_penalty"]),
+                top_k=int(self.xtts_config.top_k),
+                top_p=float(self.xtts_config.top_p),
+                enable_text_splitting=True,
+            )
 
         # Print Generation time and settings
         generate_end_time = time.time()  # Record the end time to generate TTS
         generate_elapsed_time = generate_end_time - generate_start_time
-        print(f"[{self.params['branding']}TTSGen] \033[93m{generate_elapsed_time:.2f} seconds in device {self.device}.\033[0m")
+        wav = np.asarray(out["wav"], dtype=np.float32)
+        self.record_synthesis("tts.synthesize", generate_elapsed_time, generate_elapsed_time, wav, lock_wait_seconds=lock_wait)
+        self.cache_audio(key, wav)
+        return wav
+
+    # KEEP THE TIMINGS OF THE LAST SYNTHESIS AND RECORD THEM IN THE METRICS
+    def record_synthesis(self, span_name, first_chunk_seconds, generate_seconds, wav, **attributes):
+        self.last_first_chunk_seconds = first_chunk_seconds
+        self.last_generate_seconds = generate_seconds
+        self.last_audio_seconds = len(wav) / self.sample_rate
+        metrics.record(span_name, generate_seconds, first_chunk_seconds=first_chunk_seconds, samples=len(wav),
+                       audio_seconds=self.last_audio_seconds,
+                       real_time_factor=generate_seconds / max(self.last_audio_seconds, 1e-6), **attributes)
+
+    # BATCHED SYNTHESIS OF MANY (text, voice, language) REQUESTS
+    def synthesize_batch(self, requests, batch_decode=True, decode_batch_size=8, return_exceptions=False):
+        """
+        Returns one float32 waveform per (text, voice, language) request, in the same order.
+        voice and language can be None for the defaults. Requests are grouped by voice so each
+        conditioning latent is fetched once; with batch_decode the GPT codes of every sentence of a group
+        are decoded by HiFi-GAN in padded batches, otherwise each request runs a full inference.
+        A failed request does not fail the others: with return_exceptions its exception takes the place
+        of its waveform, otherwise the first one is raised once the batch is done.
+        """
+        generate_start_time = time.time()
+        groups = {}
+        wavs = [None] * len(requests)
+        keys = [None] * len(requests)
+        errors = {}
+        for index, (text, voice, language) in enumerate(requests):
+            voice = voice or self.params["voice"]
+            language = language or self.params["language"]
+            keys[index], wavs[index] = self.cached_audio(text, voice, language)
+            if wavs[index] is None:
+                groups.setdefault(voice, []).append((index, text, language))
+
+        with self.use_model():
+            for voice, items in groups.items():
+                if batch_decode:
+                    try:
+                        gpt_cond_latent, speaker_embedding = self.get_speaker_latents(voice)
+                        results = self.batch_inference(items, gpt_cond_latent, speaker_embedding, decode_batch_size)
+                        for index, result in results.items():
+                            if isinstance(result, Exception):
+                                errors[index] = result
+                            else:
+                                wavs[index] = result
+                        continue
+                    except AttributeError as e:
+                        # The installed XTTS does not expose the internals used for batching
+                        print(f"[{self.params['branding']}TTSGen] \033[91mBatched decoding unavailable ({e}), synthesizing one by one.\033[0m")
+                        batch_decode = False
+                    except Exception as e:
+                        # The voice itself failed, e.g. a missing reference file
+                        for index, _, _ in items:
+                            errors[index] = e
+                        continue
+                for index, text, language in items:
+                    try:
+                        wavs[index] = self.synthesize(text, voice=voice, language=language, use_cache=False)
+                    except Exception as e:
+                        errors[index] = e
+        # Store what was just synthesized, cache hits are already stored
+        for items in groups.values():
+            for index, _, _ in items:
+                if wavs[index] is not None:
+                    self.cache_audio(keys[index], wavs[index])
+
+        metrics.record("tts.batch", time.time() - generate_start_time, requests=len(requests), voice_groups=len(groups),
+                       samples=sum(len(wav) for wav in wavs if wav is not None), errors=len(errors))
+        if errors and not return_exceptions:
+            raise errors[min(errors)]
+        return [errors[index] if index in errors else wav if wav is not None else np.zeros(0, dtype=np.float32)
+                for index, wav in enumerate(wavs)]
+
+    def batch_inference(self, items, gpt_cond_latent, speaker_embedding, decode_batch_size=8) -> dict:
+        """
+        Same steps as Xtts.inference, except that the HiFi-GAN decoding of all the sentences is batched.
+        items is a list of (index, text, language) sharing the conditioning latents.
+        Returns {index: waveform}, or {index: exception} for the requests that failed.
+        AttributeError is raised as is, it means the installed XTTS does not have the internals used here.
+        """
+        xtts_model = self.xtts_model
+        device = xtts_model.device
+        gpt_cond_latent = gpt_cond_latent.to(device)
+        speaker_embedding = speaker_embedding.to(device)
+        length_scale = 1.0 / max(float(self.params["local_speed"]), 0.05)
+        latents, owners = [], []
+        results = {}
+        with torch.no_grad():
+            for index, text, language in items:
+                # Seeded per request, so a request does not depend on the others in its batch
+                self.seed_generation()
+                # Remove the country code like Xtts.inference ("zh-cn" -> "zh")
+                language = language.split("-")[0]
+                request_latents = []
+                try:
+                    for sentence in split_sentence(text, language, xtts_model.tokenizer.char_limits[language]):
+                        sentence = sentence.strip().lower()
+                        if not sentence:
+                            continue
+                        text_tokens = torch.IntTensor(xtts_model.tokenizer.encode(sentence, lang=language)).unsqueeze(0).to(device)
+                        gpt_codes = xtts_model.gpt.generate(
+                            cond_latents=gpt_cond_latent,
+                            text_inputs=text_tokens,
+                            input_tokens=None,
+                            do_sample=True,
+                            top_p=float(xtts_model.config.top_p),
+                            top_k=int(xtts_model.config.top_k),
+                            temperature=float(self.params["local_temperature"]),
+                            num_return_sequences=xtts_model.gpt_batch_size,
+                            num_beams=1,
+                            length_penalty=float(xtts_model.config.length_penalty),
+                            repetition_penalty=float(self.params["local_repetition_penalty"]),
+                            output_attentions=False,
+                        )
+                        expected_output_len = torch.tensor([gpt_codes.shape[-1] * xtts_model.gpt.code_stride_len], device=device)
+                        text_len = torch.tensor([text_tokens.shape[-1]], device=device)
+                        gpt_latents = xtts_model.gpt(
+                            text_tokens,
+                            text_len,
+                            gpt_codes,
+                            expected_output_len,
+                            cond_latents=gpt_cond_latent,
+                            return_attentions=False,
+                            return_latent=True,
+                        )
+                        if length_scale != 1.0:
+                            gpt_latents = F.interpolate(gpt_latents.transpose(1, 2), scale_factor=length_scale, mode="linear").transpose(1, 2)
+                        request_latents.append(gpt_latents[0])
+                except AttributeError:
+                    raise
+                except Exception as e:
+                    results[index] = e
+                    continue
+                latents.extend(request_latents)
+                owners.extend([index] * len(request_latents))
+
+            chunks = {}
+            for start in range(0, len(latents), decode_batch_size):
+                batch = latents[start:start + decode_batch_size]
+                batch_owners = owners[start:start + decode_batch_size]
+                try:
+                    padded = torch.nn.utils.rnn.pad_sequence(batch, batch_first=True)
+                    out = xtts_model.hifigan_decoder(padded, g=speaker_embedding.expand(len(batch), -1, -1)).cpu()
+                except AttributeError:
+                    raise
+                except Exception as e:
+                    # Only the requests with a sentence in this decode batch fail
+                    for owner in batch_owners:
+                        results[owner] = e
+                    continue
+                out = out.reshape(len(batch), -1)
+                # Cut the padding of each row proportionally to its latent length
+                samples_per_frame = out.shape[-1] / padded.shape[1]
+                for row, latent in enumerate(batch):
+                    chunks.setdefault(batch_owners[row], []).append(out[row, :int(round(len(latent) * samples_per_frame))].numpy())
+        for index, wav_chunks in chunks.items():
+            if index not in results:
+                results[index] = np.concatenate(wav_chunks).astype(np.float32)
+        return results
+
+    # TTS VOICE GENERATION METHOD
+    def generate_audio(self, text, voice=None, language=None, output_file_path="", stream=None):
+        if stream is None: stream = self.params.get("streaming", True)
+        if stream:
+            # Playback starts with the first chunk, the WAV is only written when explicitly requested
+            wav = self.stream_audio(text, voice=voice, language=language)
+            if output_file_path:
+                torchaudio.save(output_file_path, torch.from_numpy(wav).unsqueeze(0), self.sample_rate)
+            return
+
+        if output_file_path == "": 
+            output_file_path = str(self.this_dir) + self.params["output_folder_wav"] + "response.wav" 
+        
+        wav = self.synthesize(text, voice=voice, language=language)
+        torchaudio.save(output_file_path, torch.from_numpy(wav).unsqueeze(0), self.sample_rate)
 
         self.play_audio(output_file_path)
 """
@@ -0,0 +1,335 @@
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from pathlib import Path
+import numpy as np
+from tts_gen.audio_sink import AudioSink, make_sink
+from instrumentation import metrics
+
+class SharedRingBuffer:
+    """
+    Single producer / single consumer float32 ring buffer in multiprocessing.shared_memory.
+    The header holds the samples written and read so far (each only increased by its owner) and the capacity,
+    the samples follow. The producer blocks while the ring is full; the consumer is told over a queue
+    how many samples were written, so it never has to poll.
+    """
+    header_items = 3
+
+    def __init__(self, capacity=0, name=None):
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.header_items * 8 + capacity * 4)
+        else:
+            # Processes started by multiprocessing share the resource tracker of the creator, which unlinks the block
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.header = np.ndarray((self.header_items,), dtype=np.int64, buffer=self.shm.buf)
+        if self.owner:
+            self.header[:] = (0, 0, capacity)
+        self.capacity = int(self.header[2])
+        self.samples = np.ndarray((self.capacity,), dtype=np.float32, buffer=self.shm.buf, offset=self.header_items * 8)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, samples, stop_event=None):
+        """Copies samples into the ring, waiting while it is full. Returns False if stop_event was set."""
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1)
+        offset = 0
+        while offset < len(samples):
+            written, read = int(self.header[0]), int(self.header[1])
+            free = self.capacity - (written - read)
+            if free == 0:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                time.sleep(0.001)
+                continue
+            position = written % self.capacity
+            count = min(len(samples) - offset, free, self.capacity - position)
+            self.samples[position:position + count] = samples[offset:offset + count]
+            offset += count
+            # Publish the samples only once they are copied
+            self.header[0] = written + count
+        return True
+
+    def read(self, count):
+        """Returns the next count samples, which the producer announced as written."""
+        out = np.empty(count, dtype=np.float32)
+        read = int(self.header[1])
+        offset = 0
+        while offset < count:
+            position = (read + offset) % self.capacity
+            n = min(count - offset, self.capacity - position)
+            out[offset:offset + n] = self.samples[position:position + n]
+            offset += n
+        self.header[1] = read + count
+        return out
+
+    def close(self):
+        # The numpy views must be released before the memory can be closed
+        del self.header, self.samples
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class SharedMemorySink(AudioSink):
+    """Worker side sink: writes the synthesized chunks into the ring and announces them on the result queue."""
+    def __init__(self, ring, results, request_id, sample_rate=24000):
+        super().__init__(sample_rate)
+        self.ring = ring
+        self.results = results
+        self.request_id = request_id
+
+    def write(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float32).reshape(-1)
+        # Pieces of half the ring, so the consumer can drain one while the next is written
+        step = max(self.ring.capacity // 2, 1)
+        for start in range(0, len(chunk), step):
+            piece = chunk[start:start + step]
+            self.ring.write(piece)
+            self.results.put(("chunk", self.request_id, len(piece)))
+
+def worker_main(requests, results, ring_name, threads, profile_settings):
+    """Entry point of the TTS process: loads XTTS with its own thread budget and serves the requests in order."""
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+    from tts_gen.tts_main import TextToSpeechGenerator
+    from tts_gen.audio_sink import NullSink
+    from cpu_profile import ModelProfile
+
+    ring = SharedRingBuffer(name=ring_name)
+    tts = TextToSpeechGenerator(sink=NullSink(), cpu_profile=ModelProfile(**profile_settings) if profile_settings else None)
+    results.put(("ready", None, tts.sample_rate))
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, text, voice, language, stream, use_cache = request
+        results.put(("start", request_id, None))
+        sink = SharedMemorySink(ring, results, request_id, tts.sample_rate)
+        try:
+            if stream:
+                tts.stream_audio(text, voice=voice, language=language, sink=sink, wait=False, use_cache=use_cache)
+            else:
+                sink.write(tts.synthesize(text, voice=voice, language=language, use_cache=use_cache))
+            results.put(("done", request_id, {"generate_seconds": tts.last_generate_seconds}))
+        except Exception as e:
+            results.put(("error", request_id, f"{type(e).__name__}: {e}"))
+    ring.close()
+
+class WorkerRequest:
+    def __init__(self, request_id, message, sink):
+        self.request_id = request_id
+        self.message = message
+        self.sink = sink
+        self.future = Future()
+        self.chunks = []
+        self.started = False
+        self.submit_time = time.time()
+        self.first_chunk_seconds = None
+
+class TTSWorker:
+    """
+    Runs XTTS in a dedicated process so synthesis runs in parallel with text generation,
+    without sharing the GIL or the torch thread pool of the main process.
+    Requests go over a multiprocessing queue and the PCM comes back through a shared memory ring buffer.
+    If the process dies, it is restarted: the request it was synthesizing fails, the queued ones are sent again.
+    Exposes the parts of the TextToSpeechGenerator interface used by the assistant.
+    """
+    def __init__(self, sink=None, cpu_profile=None, threads=0, ring_seconds=10, max_restarts=5):
+        self.this_dir = Path(__file__).parent.resolve()
+        with open(self.this_dir / "config" / "tts_config.json", "r") as config_file:
+            self.params = json.load(config_file)
+        self.sample_rate = 24000
+        self.sink = sink if sink is not None else make_sink(self.params.get("audio_sink", "pyaudio"),
+                                                            sample_rate=self.sample_rate,
+                                                            device_name=self.params["device_output"])
+        self.context = multiprocessing.get_context("spawn")
+        self.profile_settings = cpu_profile.to_dict() if cpu_profile is not None else None
+        # Own thread budget, half of the cores unless the CPU profile sets it
+        self.threads = threads or (cpu_profile.threads if cpu_profile is not None and cpu_profile.threads else 0) \
+            or max((os.cpu_count() or 2) // 2, 1)
+        self.ring_capacity = int(ring_seconds * self.sample_rate)
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.pending = {}
+        self.request_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.running = True
+        # Sent with every request, the audio cache itself lives in the worker process
+        self.use_cache = True
+        self.last_first_chunk_seconds = 0.0
+        self.last_generate_seconds = 0.0
+        self.last_audio_seconds = 0.0
+        self.start_process()
+        self.reader = threading.Thread(target=self.read_results, name="tts_worker_reader", daemon=True)
+        self.reader.start()
+        self.wait_ready()
+
+    def start_process(self):
+        self.ready.clear()
+        with self.lock:
+            # Fresh queues and ring: a process killed while using them can leave them in an unusable state
+            self.requests = self.context.Queue()
+            self.results = self.context.Queue()
+            self.ring = SharedRingBuffer(self.ring_capacity)
+            self.process = self.context.Process(target=worker_main, name="tts_worker", daemon=True,
+                                                args=(self.requests, self.results, self.ring.name, self.threads, self.profile_settings))
+            self.process.start()
+            # Requests not started by the previous process are sent again
+            for request in self.pending.values():
+                self.requests.put(request.message)
+
+    def wait_ready(self):
+        while not self.ready.wait(timeout=0.5):
+            if not self.running:
+                raise RuntimeError("TTS worker could not be started.")
+
+    ### RESULTS ###
+    def read_results(self):
+        while self.running:
+            try:
+                kind, request_id, payload = self.results.get(timeout=0.5)
+            except queue.Empty:
+                if self.running and not self.process.is_alive():
+                    self.restart()
+                continue
+            if kind == "ready":
+                self.sample_rate = payload
+                self.ready.set()
+                continue
+            with self.lock:
+                request = self.pending.get(request_id)
+            if kind == "chunk":
+                # Always consume the samples so the ring stays in sync
+                samples = self.ring.read(payload)
+                if request is not None:
+                    self.add_chunk(request, samples)
+            elif request is None:
+                continue
+            elif kind == "start":
+                request.started = True
+            elif kind == "done":
+                self.finish(request, payload)
+            elif kind == "error":
+                self.fail(request, RuntimeError(f"TTS worker: {payload}"))
+
+    def add_chunk(self, request, samples):
+        if request.first_chunk_seconds is None:
+            request.first_chunk_seconds = time.time() - request.submit_time
+        request.chunks.append(samples)
+        if request.sink is not None:
+            request.sink.write(samples)
+
+    def finish(self, request, stats):
+        with self.lock:
+            self.pending.pop(request.request_id, None)
+        wav = np.concatenate(request.chunks) if request.chunks else np.zeros(0, dtype=np.float32)
+        elapsed = time.time() - request.submit_time
+        self.last_first_chunk_seconds = request.first_chunk_seconds or elapsed
+        self.last_generate_seconds = elapsed
+        self.last_audio_seconds = len(wav) / self.sample_rate
+        metrics.record("tts.worker", elapsed, first_chunk_seconds=self.last_first_chunk_seconds, samples=len(wav),
+                       worker_generate_seconds=stats["generate_seconds"], transport_seconds=max(elapsed - stats["generate_seconds"], 0.0))
+        if request.sink is not None:
+            request.sink.finish()
+        request.future.set_result(wav)
+
+    def fail(self, request, error):
+        with self.lock:
+            self.pending.pop(request.request_id, None)
+        if request.sink is not None:
+            request.sink.finish()
+        request.future.set_exception(error)
+
+    def restart(self):
+        """Called by the reader when the process died. Fails the request in progress, so a request crashing
+        the worker is not retried forever, and starts a new process."""
+        with self.lock:
+            in_progress = [request for request in self.pending.values() if request.started]
+            if not in_progress and self.pending and self.ready.is_set():
+                # The "start" message can be lost with the process, requests are served in order so it was the oldest
+                in_progress = [next(iter(self.pending.values()))]
+        for request in in_progress:
+            self.fail(request, RuntimeError(f"TTS worker crashed (exit code {self.process.exitcode})."))
+        self.ring.close()
+        if self.restarts >= self.max_restarts:
+            print(f"[TTS_WORKER] \033[91mWorker crashed {self.restarts + 1} times, giving up.\033[0m")
+            self.running = False
+            with self.lock:
+                waiting = list(self.pending.values())
+            for request in waiting:
+                self.fail(request, RuntimeError("TTS worker is not running."))
+            return
+        self.restarts += 1
+        metrics.record("tts.worker_restart", 0.0, exit_code=self.process.exitcode or 0)
+        print(f"[TTS_WORKER] \033[91mWorker exited with code {self.process.exitcode}, restarting.\033[0m")
+        self.start_process()
+
+    ### REQUESTS ###
+    def submit(self, text, voice=None, language=None, stream=False, sink=None, use_cache=True) -> Future:
+        """Queues a synthesis, the Future is resolved with the whole waveform. With a sink, chunks are written to it as they arrive."""
+        if not self.running:
+            raise RuntimeError("TTS worker is not running.")
+        request_id = next(self.request_ids)
+        request = WorkerRequest(request_id, (request_id, text, voice, language, stream, use_cache and self.use_cache), sink)
+        with self.lock:
+            self.pending[request_id] = request
+            self.requests.put(request.message)
+        return request.future
+
+    def synthesize(self, text, voice=None, language=None, use_cache=True):
+        return self.submit(text, voice, language, use_cache=use_cache).result()
+
+    def disable_audio_cache(self):
+        self.use_cache = False
+
+    def synthesize_batch(self, requests, return_exceptions=False, **kwargs):
+        # The worker serves one request at a time, queue them all so it never waits for the next one
+        futures = [self.submit(text, voice, language) for text, voice, language in requests]
+        if return_exceptions:
+            return [future.exception() or future.result() for future in futures]
+        return [future.result() for future in futures]
+
+    def stream_audio(self, text, voice=None, language=None, sink=None, wait=True):
+        if sink is None: sink = self.sink
+        wav = self.submit(text, voice, language, stream=True, sink=sink).result()
+        if wait:
+            sink.wait()
+        return wav
+
+    def play_wav(self, wav):
+        self.sink.play(np.asarray(wav, dtype=np.float32))
+
+    def generate_audio(self, text, voice=None, language=None, output_file_path="", stream=None):
+        from stt_gen.audio_utils import write_wav
+        if stream is None: stream = self.params.get("streaming", True)
+        if stream:
+            wav = self.stream_audio(text, voice=voice, language=language)
+        else:
+            wav = self.synthesize(text, voice=voice, language=language)
+            self.play_wav(wav)
+        if output_file_path:
+            write_wav(output_file_path, wav, self.sample_rate)
+
+    def stats(self) -> dict:
+        with self.lock:
+            pending = len(self.pending)
+        return {"alive": self.process.is_alive(), "pid": self.process.pid, "restarts": self.restarts, "pending": pending}
+
+    def close(self, timeout=5.0):
+        self.running = False
+        self.requests.put(None)
+        self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.reader.join(timeout=timeout)
+        self.ring.close()